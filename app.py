@@ -1,6 +1,4 @@
 import torch
-import requests
-import tempfile
 import gradio as gr
 
 from deepseek_vl.models import VLChatProcessor, MultiModalityCausalLM
@@ -25,41 +23,38 @@ def generate_caption(image):
     Returns:
         str: The generated caption.
     """
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=True) as tmp_file:
-        image.save(tmp_file.name)
-
-        conversation = [
-            {
-                "role": "User",
-                "content": "<image_placeholder><TOPAZ AUTO CLIP CAPTION> Caption this image.",
-                "images": [tmp_file.name],
-            },
-            {"role": "Assistant", "content": ""},
-        ]
-
-        # Load images and prepare for inputs
-        pil_images = load_pil_images(conversation)
-        prepare_inputs = vl_chat_processor(
-            conversations=conversation, images=pil_images, force_batchify=True
-        ).to(vl_gpt.device)
-
-        # Run image encoder to get the image embeddings
-        inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
-
-        # Run the model to get the response
-        outputs = vl_gpt.language_model.generate(
-            inputs_embeds=inputs_embeds,
-            attention_mask=prepare_inputs.attention_mask,
-            pad_token_id=tokenizer.eos_token_id,
-            bos_token_id=tokenizer.bos_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-            max_new_tokens=512,
-            do_sample=False,
-            use_cache=True,
-        )
-
-        answer = tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
-        return answer
+    conversation = [
+        {
+            "role": "User",
+            "content": "<image_placeholder><TOPAZ AUTO CLIP CAPTION> Caption this image.",
+            "images": [image],
+        },
+        {"role": "Assistant", "content": ""},
+    ]
+
+    # Load images and prepare for inputs
+    pil_images = load_pil_images(conversation)
+    prepare_inputs = vl_chat_processor(
+        conversations=conversation, images=pil_images, force_batchify=True
+    ).to(vl_gpt.device)
+
+    # Run image encoder to get the image embeddings
+    inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
+
+    # Run the model to get the response
+    outputs = vl_gpt.language_model.generate(
+        inputs_embeds=inputs_embeds,
+        attention_mask=prepare_inputs.attention_mask,
+        pad_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        max_new_tokens=512,
+        do_sample=False,
+        use_cache=True,
+    )
+
+    answer = tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
+    return answer
 
 
 # Create Gradio interface
@@ -186,6 +186,11 @@ def chat(args, tokenizer, vl_chat_processor, vl_gpt, generation_config):
 def main(args):
     # setup
     tokenizer, vl_chat_processor, vl_gpt = load_pretrained_model(args.model_path)
+    if args.images_embeds_cache_bytes > 0:
+        # every turn re-sends the earlier images, only encode each of them once
+        vl_gpt.enable_images_embeds_cache(
+            max_device_bytes=args.images_embeds_cache_bytes
+        )
     generation_config = dict(
         pad_token_id=vl_chat_processor.tokenizer.eos_token_id,
         bos_token_id=vl_chat_processor.tokenizer.bos_token_id,
@@ -220,5 +225,11 @@ if __name__ == "__main__":
     parser.add_argument("--top_p", type=float, default=0.95)
     parser.add_argument("--repetition_penalty", type=float, default=1.1)
     parser.add_argument("--max_gen_len", type=int, default=512)
+    parser.add_argument(
+        "--images_embeds_cache_bytes",
+        type=int,
+        default=0,
+        help="GPU memory budget for the embeddings of already seen images, 0 (default) disables the cache.",
+    )
     args = parser.parse_args()
     main(args)
@@ -1,14 +1,21 @@
+import asyncio
+import json
 import os
+import threading
 import time
-from typing import Optional
-from fastapi import FastAPI, HTTPException
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Union
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import torch
 import base64
 from io import BytesIO
 from PIL import Image
-import tempfile
 import pycld2
 
 import PIL
@@ -27,8 +34,28 @@ else:
         "HUGGINGFACE_TOKEN not found in environment variables. Some model downloads may fail."
     )
 
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 from deepseek_vl.models import VLChatProcessor, MultiModalityCausalLM
+from deepseek_vl.models.processing_vlm import BatchBufferPool, VLChatProcessorOutput
+from deepseek_vl.serve.caption_cache import CaptionCache
+from deepseek_vl.serve.engine import ContinuousBatchingEngine
+from deepseek_vl.serve.kv_cache import PagedKVCache
+from deepseek_vl.serve.image_budget import ImageTooLargeError, MemoryBudget, decode_image
+from deepseek_vl.serve.inference import (
+    AsyncTextStreamer,
+    BatchStreamer,
+    CancellationCriteria,
+)
+from deepseek_vl.serve.prefix_cache import PrefixKVCache, shared_prefix, text_prefix
+from deepseek_vl.serve.scheduler import MicroBatcher
+from deepseek_vl.serve.speculative import (
+    DraftModelProposer,
+    PhraseTrie,
+    PromptLookupProposer,
+    SpeculativeStats,
+    speculative_generate,
+)
 from deepseek_vl.utils.io import load_pil_images
 # from vllm import LLM, SamplingParams
 # from llama_cpp import Llama
@@ -50,15 +77,121 @@ CHECKPOINT_PATH = os.getenv("DEEPSEEK_MODEL_PATH")
 if not CHECKPOINT_PATH:
     raise ValueError("DEEPSEEK_MODEL_PATH environment variable not set")
 
+# Caption requests arriving within MAX_WAIT_MS of each other are batched together
+MAX_BATCH_SIZE = int(os.getenv("DEEPSEEK_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.getenv("DEEPSEEK_MAX_WAIT_MS", "10"))
+
+# A /v1/caption/batch request lists at most MAX_BATCH_REQUEST_IMAGES images (413 over
+# it, 0 disables the limit). Across all the batch requests, at most BATCH_IN_FLIGHT_IMAGES
+# images are decoded, preprocessed or waiting on the model at once: every one of them
+# holds its preprocessed pixels (~12 MB at 1024x1024).
+MAX_BATCH_REQUEST_IMAGES = int(os.getenv("DEEPSEEK_MAX_BATCH_REQUEST_IMAGES", "4096"))
+BATCH_IN_FLIGHT_IMAGES = int(
+    os.getenv("DEEPSEEK_BATCH_IN_FLIGHT_IMAGES", str(4 * MAX_BATCH_SIZE))
+)
+
+# Generate the captions with iteration-level batching: a caption leaves the batch as
+# soon as it is done and new requests join the running ones after their prefill,
+# up to MAX_RUNNING_SEQUENCES at once (MAX_BATCH_SIZE are prefilled per step)
+CONTINUOUS_BATCHING = os.getenv("DEEPSEEK_CONTINUOUS_BATCHING", "0") == "1"
+MAX_RUNNING_SEQUENCES = int(os.getenv("DEEPSEEK_MAX_RUNNING_SEQUENCES", "32"))
+
+# With continuous batching, keep the KV cache in a pool of blocks of this many bytes
+# instead of one padded tensor per layer. The captions whose prompts start with the
+# same text share its blocks. A size of 0 disables the pool. This is a reference
+# layout without a paged-attention kernel: each decode step gathers every caption's
+# KV back into a padded tensor per layer, it bounds the memory, it is not faster.
+PAGED_KV_CACHE_BYTES = int(os.getenv("DEEPSEEK_PAGED_KV_CACHE_BYTES", "0"))
+KV_BLOCK_SIZE = int(os.getenv("DEEPSEEK_KV_BLOCK_SIZE", "16"))
+
+# Captions are cached by image content, prompt, max_new_tokens and checkpoint.
+# A cache size of 0 disables the cache, the sqlite tier is only used when a
+# directory is given and keeps at most CAPTION_CACHE_DISK_SIZE captions (0 for no
+# limit).
+CAPTION_CACHE_SIZE = int(os.getenv("DEEPSEEK_CAPTION_CACHE_SIZE", "1024"))
+CAPTION_CACHE_TTL = os.getenv("DEEPSEEK_CAPTION_CACHE_TTL")
+CAPTION_CACHE_DIR = os.getenv("DEEPSEEK_CAPTION_CACHE_DIR")
+CAPTION_CACHE_DISK_SIZE = int(os.getenv("DEEPSEEK_CAPTION_CACHE_DISK_SIZE", "65536"))
+
+# Images are decoded and preprocessed by this many worker threads, concurrently with
+# the model; PIL releases the GIL while decoding and resizing
+PREPROCESS_WORKERS = int(
+    os.getenv("DEEPSEEK_PREPROCESS_WORKERS", str(min(8, os.cpu_count() or 1)))
+)
+
+# Uploads over MAX_IMAGE_BYTES, or with more than MAX_IMAGE_PIXELS pixels after a
+# reduced-scale JPEG decode, are rejected with a 413 (0 disables a limit). Concurrent
+# decodes wait while their decoded pixels would exceed DECODE_MEMORY_BYTES.
+MAX_IMAGE_PIXELS = int(os.getenv("DEEPSEEK_MAX_IMAGE_PIXELS", str(64 * 1024 * 1024)))
+MAX_IMAGE_BYTES = int(os.getenv("DEEPSEEK_MAX_IMAGE_BYTES", str(50 * 1024 * 1024)))
+DECODE_MEMORY_BYTES = int(os.getenv("DEEPSEEK_DECODE_MEMORY_BYTES", str(2 << 30)))
+
+# KV cache of the text the prompts start with (system prompt, role tag), shared by
+# all the requests. A size of 0 disables it.
+PREFIX_CACHE_BYTES = int(os.getenv("DEEPSEEK_PREFIX_CACHE_BYTES", str(512 << 20)))
+
+# Decode the captions speculatively: a smaller checkpoint with the same tokenizer (e.g.
+# deepseek-vl-1.3b-chat for deepseek-vl-7b-chat) proposes NUM_SPECULATIVE_TOKENS tokens
+# that the model checks in one forward. The captions are the same as without it.
+# Used by the batched and streaming paths, not by the continuous-batching engine.
+DRAFT_MODEL_PATH = os.getenv("DEEPSEEK_DRAFT_MODEL_PATH")
+NUM_SPECULATIVE_TOKENS = int(os.getenv("DEEPSEEK_NUM_SPECULATIVE_TOKENS", "4"))
+
+# Without a draft model, propose the tokens that followed the last few tokens in the
+# prompt, in the recent captions, or in the phrases of PHRASE_LIST_PATH (one per line).
+# The proposals are looked up on the host, they take no GPU memory. A round without a
+# proposal for every caption of the batch is a plain decode step, so the gain depends
+# on how repetitive the captions are: it is off by default, turn it on once the
+# tokens_per_forward of /v1/caption/speculative/stats shows it pays off.
+PROMPT_LOOKUP = os.getenv("DEEPSEEK_PROMPT_LOOKUP", "0") == "1"
+PHRASE_LIST_PATH = os.getenv("DEEPSEEK_PHRASE_LIST_PATH")
+
+# Run the high-res (SAM) and low-res (SigLIP) vision towers concurrently
+CONCURRENT_VISION_TOWERS = os.getenv("DEEPSEEK_CONCURRENT_VISION_TOWERS", "0") == "1"
+
 # Load model and tokenizer globally
 logging.info("Loading model...")
 vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(CHECKPOINT_PATH)
 tokenizer = vl_chat_processor.tokenizer
+# the preprocess workers hash the pixels, a batch then encodes its duplicated images once
+vl_chat_processor.dedup_images = True
 
 vl_gpt: MultiModalityCausalLM = MultiModalityCausalLM.from_pretrained(
     CHECKPOINT_PATH, trust_remote_code=True
 )
 vl_gpt = vl_gpt.to(torch.bfloat16).cuda().eval()
+if hasattr(vl_gpt.vision_model, "concurrent_towers"):
+    vl_gpt.vision_model.concurrent_towers = CONCURRENT_VISION_TOWERS
+
+draft_vl_chat_processor: Optional[VLChatProcessor] = None
+draft_vl_gpt: Optional[MultiModalityCausalLM] = None
+if DRAFT_MODEL_PATH:
+    logging.info("Loading draft model...")
+    draft_vl_chat_processor = VLChatProcessor.from_pretrained(DRAFT_MODEL_PATH)
+    if draft_vl_chat_processor.tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise ValueError(
+            f"The draft model {DRAFT_MODEL_PATH} does not share the tokenizer of {CHECKPOINT_PATH}"
+        )
+    draft_vl_gpt = MultiModalityCausalLM.from_pretrained(
+        DRAFT_MODEL_PATH, trust_remote_code=True
+    )
+    draft_vl_gpt = draft_vl_gpt.to(torch.bfloat16).cuda().eval()
+    if CONTINUOUS_BATCHING:
+        logging.warning(
+            "The continuous-batching engine does not decode speculatively, the draft "
+            "model is not used"
+        )
+
+# The phrases and the n-grams of the recent captions, when there is no draft model
+phrase_trie: Optional[PhraseTrie] = None
+if PROMPT_LOOKUP and draft_vl_gpt is None:
+    phrase_trie = PhraseTrie()
+    if PHRASE_LIST_PATH:
+        with open(PHRASE_LIST_PATH) as f:
+            phrase_trie.add_phrases(tokenizer, filter(None, map(str.strip, f)))
+
+# Accepted draft tokens of the speculative decoding
+speculative_stats = SpeculativeStats()
 
 # Load translation model
 TRANSLATION_MODEL_PATH = "/app/models/translation_model"
@@ -67,10 +200,35 @@ import torch
 translation_tokenizer = AutoTokenizer.from_pretrained(TRANSLATION_MODEL_PATH)
 gemma = Gemma3ForCausalLM.from_pretrained(TRANSLATION_MODEL_PATH).to(torch.bfloat16)
 
+# The translation model is only ever driven from this worker thread, so the event
+# loop stays free while a translation runs
+translation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="translation")
+
+# Host buffers the caption batches are built in, reused from batch to batch
+batch_buffer_pool = BatchBufferPool()
+
+prefix_cache: Optional[PrefixKVCache] = None
+if PREFIX_CACHE_BYTES > 0:
+    prefix_cache = PrefixKVCache(vl_gpt.language_model, max_bytes=PREFIX_CACHE_BYTES)
+
+# In-flight decoded bytes of all the uploads being decoded
+decode_budget = MemoryBudget(DECODE_MEMORY_BYTES)
+
+# Decode and preprocess stage, the caption batcher only receives ready pixel tensors
+preprocess_executor = ThreadPoolExecutor(
+    max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess"
+)
+
+# The images of the batch requests between their decode and their caption
+batch_in_flight = asyncio.Semaphore(BATCH_IN_FLIGHT_IMAGES)
+
+DEFAULT_CAPTION_PROMPT = "<TOPAZ AUTO CLIP CAPTION> Caption this image."
+
+
 # Pydantic models for API
 class ImageRequest(BaseModel):
     image: str  # base64 encoded image
-    prompt: Optional[str] = "<TOPAZ AUTO CLIP CAPTION> Caption this image."
+    prompt: Optional[str] = DEFAULT_CAPTION_PROMPT
     max_new_tokens: Optional[int] = 128
 
 
@@ -78,6 +236,19 @@ class CaptionResponse(BaseModel):
     caption: str
 
 
+class BatchCaptionRequest(BaseModel):
+    images: List[ImageRequest]
+
+
+class BatchCaptionResult(BaseModel):
+    caption: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchCaptionResponse(BaseModel):
+    results: List[BatchCaptionResult]
+
+
 class TranslationRequest(BaseModel):
     prompt: str
 
@@ -172,68 +343,648 @@ def translate_text(text, max_tokens=512, temperature=0.1, top_p=0.9):
     return (language, translation)
 
 
+def decode_within_budget(image_data) -> Image.Image:
+    # the image is downscaled as the processor would before it leaves the budget, the
+    # processor then leaves it as is
+    return decode_image(
+        image_data,
+        max_size=vl_chat_processor.image_processor.image_size,
+        max_pixels=MAX_IMAGE_PIXELS or None,
+        max_bytes=MAX_IMAGE_BYTES or None,
+        budget=decode_budget,
+        resize=vl_chat_processor.image_processor.resize_keep_ratio,
+    )
+
+
 def process_base64_image(image_data: str) -> Image.Image:
     """Process base64 image data into PIL Image"""
     try:
         # Remove data URL prefix if present
         if image_data.startswith("data:image"):
             image_data = image_data.split(",")[1]
-        image_bytes = base64.b64decode(image_data)
-        return Image.open(BytesIO(image_bytes)).convert("RGB")
+        # Reject oversized payloads before decoding the base64
+        if MAX_IMAGE_BYTES and len(image_data) * 3 // 4 > MAX_IMAGE_BYTES:
+            raise ImageTooLargeError(
+                f"Image data exceeds the limit of {MAX_IMAGE_BYTES} bytes"
+            )
+        return decode_within_budget(base64.b64decode(image_data))
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
 
 
-@app.post("/v1/caption", response_model=CaptionResponse)
-async def generate_caption(request: ImageRequest):
+def process_image_file(image_file) -> Image.Image:
+    """Process an uploaded image file object into PIL Image"""
     try:
-        # Process the image
-        image = process_base64_image(request.image)
-
-        # Generate caption using temporary file
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=True) as tmp_file:
-            image.save(tmp_file.name)
-            query = f"<img>{tmp_file.name}</img>{request.prompt}"
-            conversation = [
-                {
-                    "role": "User",
-                    "content": f"<image_placeholder>{request.prompt}",
-                    "images": [tmp_file.name],
-                },
-                {"role": "Assistant", "content": ""},
+        return decode_within_budget(image_file)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
+
+
+@dataclass
+class CaptionJob:
+    image: Image.Image
+    prompt: str
+    max_new_tokens: int
+    # filled in by the preprocess workers, see prepare_job
+    prepared: Optional[VLChatProcessorOutput] = None
+    # the inputs of the draft model, when decoding speculatively
+    draft_prepared: Optional[VLChatProcessorOutput] = None
+    # set for the streamed captions, see /v1/caption/stream
+    streamer: Optional[BaseStreamer] = None
+    cancel_event: Optional[threading.Event] = None
+
+
+def prepare_caption(job: CaptionJob, processor: Optional[VLChatProcessor] = None):
+    processor = processor or vl_chat_processor
+    conversation = [
+        {
+            "role": "User",
+            "content": f"<image_placeholder>{job.prompt}",
+            "images": [job.image],
+        },
+        {"role": "Assistant", "content": ""},
+    ]
+    return processor.process_one(
+        conversations=conversation, images=load_pil_images(conversation)
+    )
+
+
+async def run_in_preprocess_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(preprocess_executor, func, *args)
+
+
+async def prepare_job(job: CaptionJob) -> CaptionJob:
+    """Tokenize and preprocess the job on the preprocess workers."""
+    job.prepared = await run_in_preprocess_executor(prepare_caption, job)
+    if draft_vl_gpt is not None:
+        job.draft_prepared = await run_in_preprocess_executor(
+            prepare_caption, job, draft_vl_chat_processor
+        )
+    return job
+
+
+def generate_inputs(
+    prepare_list: List[VLChatProcessorOutput], prepare_inputs, inputs_embeds
+) -> dict:
+    """
+    The prompt inputs of `generate`. With the prefix cache, the text the prompts share
+    before their images comes from the cache instead of being prefilled again, and
+    `generate` returns the prompt ids in front of the new tokens.
+    """
+    if prefix_cache is not None:
+        # the cached KV is only valid for this checkpoint and chat template
+        prefix_cache.validate(
+            (
+                CHECKPOINT_PATH,
+                vl_chat_processor.sft_format,
+                vl_chat_processor.system_prompt,
+            )
+        )
+        prefix_ids = shared_prefix(
+            [prepare.input_ids.tolist() for prepare in prepare_list],
+            vl_chat_processor.image_id,
+        )
+        if len(prefix_ids) > 0:
+            return prefix_cache.prefill(
+                prefix_ids,
+                prepare_inputs.input_ids,
+                inputs_embeds,
+                prepare_inputs.attention_mask,
+            )
+
+    return dict(inputs_embeds=inputs_embeds, attention_mask=prepare_inputs.attention_mask)
+
+
+def draft_proposer(jobs: List[CaptionJob]) -> DraftModelProposer:
+    """The draft model, prefilled with the prompts of the jobs."""
+    prepare_list = [
+        (
+            job.draft_prepared
+            if job.draft_prepared is not None
+            else prepare_caption(job, draft_vl_chat_processor)
+        )
+        for job in jobs
+    ]
+    prepare_inputs = draft_vl_chat_processor.batchify(
+        prepare_list,
+        dtype=draft_vl_gpt.dtype,
+        pin_memory=True,
+        buffer_pool=batch_buffer_pool,
+    ).to(draft_vl_gpt.device, dtype=draft_vl_gpt.dtype)
+    return DraftModelProposer(
+        draft_vl_gpt.language_model,
+        draft_vl_gpt.prepare_inputs_embeds(**prepare_inputs),
+        prepare_inputs.attention_mask,
+    )
+
+
+def prompt_lookup_proposer(
+    prepare_list: List[VLChatProcessorOutput],
+) -> PromptLookupProposer:
+    """Looks up the text of the prompts, then the phrases and the recent captions."""
+    return PromptLookupProposer(
+        phrase_trie,
+        [
+            [
+                token_id
+                for token_id in prepare.input_ids.tolist()
+                if token_id != vl_chat_processor.image_id
             ]
+            for prepare in prepare_list
+        ],
+    )
 
-            pil_images = load_pil_images(conversation)
-            prepare_inputs = vl_chat_processor(
-                conversations=conversation, images=pil_images, force_batchify=True
-            ).to(vl_gpt.device)
 
-            # run image encoder to get the image embeddings
-            inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
+def generate_captions(
+    jobs: List[CaptionJob],
+    prepare_list: List[VLChatProcessorOutput],
+    inputs: dict,
+    max_new_tokens: int,
+    **kwargs,
+) -> torch.LongTensor:
+    """
+    Greedy decoding of the captions from the `generate_inputs`, speculative with a draft
+    model or prompt lookup. Returns only the new tokens.
+    """
+    if draft_vl_gpt is not None or phrase_trie is not None:
+        outputs = speculative_generate(
+            vl_gpt.language_model,
+            (
+                draft_proposer(jobs)
+                if draft_vl_gpt is not None
+                else prompt_lookup_proposer(prepare_list)
+            ),
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            num_speculative_tokens=NUM_SPECULATIVE_TOKENS,
+            stats=speculative_stats,
+            **inputs,
+            **kwargs,
+        )
+        if phrase_trie is not None:
+            for output, job in zip(outputs.tolist(), jobs):
+                output = output[: job.max_new_tokens]
+                if tokenizer.eos_token_id in output:
+                    output = output[: output.index(tokenizer.eos_token_id) + 1]
+                phrase_trie.add(output)
+        return outputs
+
+    outputs = vl_gpt.language_model.generate(
+        **inputs,
+        pad_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        use_cache=True,
+        **kwargs,
+    )
+    if "input_ids" in inputs:
+        outputs = outputs[:, inputs["input_ids"].shape[1] :]
+    return outputs
+
 
-            # run the model to get the response
-            outputs = vl_gpt.language_model.generate(
-                inputs_embeds=inputs_embeds,
-                attention_mask=prepare_inputs.attention_mask,
-                pad_token_id=tokenizer.eos_token_id,
-                bos_token_id=tokenizer.bos_token_id,
+@torch.inference_mode()
+def caption_batch(jobs: List[CaptionJob]) -> List[Union[str, Exception]]:
+    """
+    Caption a batch of images with one batched prefill and one `generate` call.
+
+    A job that cannot be preprocessed gets its exception as result, the other jobs
+    of the batch are still captioned. The jobs with a streamer receive their tokens as
+    they are generated, and stop early when their `cancel_event` is set.
+    """
+    try:
+        return caption_prepared_batch(jobs)
+    finally:
+        # unblock the stream consumers even if generation failed before streaming
+        for job in jobs:
+            if job.streamer is not None:
+                job.streamer.end()
+
+
+def caption_prepared_batch(jobs: List[CaptionJob]) -> List[Union[str, Exception]]:
+    results: List[Union[str, Exception]] = [None] * len(jobs)
+    prepare_list, prepared_indices = [], []
+    for i, job in enumerate(jobs):
+        try:
+            prepare_list.append(
+                job.prepared if job.prepared is not None else prepare_caption(job)
+            )
+        except Exception as e:
+            results[i] = e
+            continue
+        prepared_indices.append(i)
+
+    if len(prepare_list) == 0:
+        return results
+    jobs = [jobs[i] for i in prepared_indices]
+
+    # left-pad the conversations into one batch, built in pinned memory in the model
+    # dtype so the copy to the GPU is a single asynchronous transfer
+    prepare_inputs = vl_chat_processor.batchify(
+        prepare_list, dtype=vl_gpt.dtype, pin_memory=True, buffer_pool=batch_buffer_pool
+    ).to(vl_gpt.device, dtype=vl_gpt.dtype)
+
+    # run image encoder to get the image embeddings
+    inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
+    inputs = generate_inputs(prepare_list, prepare_inputs, inputs_embeds)
+
+    kwargs = {}
+    if any(job.streamer is not None for job in jobs):
+        kwargs.update(
+            streamer=BatchStreamer(
+                [job.streamer for job in jobs],
+                [job.max_new_tokens for job in jobs],
                 eos_token_id=tokenizer.eos_token_id,
-                max_new_tokens=request.max_new_tokens,
-                do_sample=False,
-                use_cache=True,
+            ),
+            stopping_criteria=StoppingCriteriaList(
+                [CancellationCriteria([job.cancel_event for job in jobs])]
+            ),
+        )
+
+    # run the model to get the responses, greedy decoding lets every job stop at its
+    # own max_new_tokens by truncating the shared output
+    outputs = generate_captions(
+        jobs,
+        prepare_list,
+        inputs,
+        max_new_tokens=max(job.max_new_tokens for job in jobs),
+        **kwargs,
+    )
+    outputs = outputs.cpu().tolist()
+    for i, job, output in zip(prepared_indices, jobs, outputs):
+        results[i] = tokenizer.decode(
+            output[: job.max_new_tokens], skip_special_tokens=True
+        )
+    return results
+
+
+caption_batcher = MicroBatcher(
+    caption_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_WAIT_MS,
+    name="caption-batcher",
+)
+
+
+@torch.inference_mode()
+def embed_captions(jobs: List[CaptionJob]) -> List[torch.Tensor]:
+    """Prompt embeddings of the jobs the caption engine admits, encoded as one batch."""
+    prepare_list = [
+        job.prepared if job.prepared is not None else prepare_caption(job)
+        for job in jobs
+    ]
+    prepare_inputs = vl_chat_processor.batchify(
+        prepare_list, dtype=vl_gpt.dtype, pin_memory=True, buffer_pool=batch_buffer_pool
+    ).to(vl_gpt.device, dtype=vl_gpt.dtype)
+    inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
+
+    # drop the left padding
+    lengths = prepare_inputs.attention_mask.sum(dim=1).tolist()
+    return [
+        embeds[len(embeds) - length :] for embeds, length in zip(inputs_embeds, lengths)
+    ]
+
+
+caption_engine: Optional[ContinuousBatchingEngine] = None
+if CONTINUOUS_BATCHING:
+    caption_engine = ContinuousBatchingEngine(
+        vl_gpt.language_model,
+        eos_token_id=tokenizer.eos_token_id,
+        embed=embed_captions,
+        max_running=MAX_RUNNING_SEQUENCES,
+        max_prefill_size=MAX_BATCH_SIZE,
+        kv_cache=(
+            PagedKVCache.from_config(
+                vl_gpt.language_model.config,
+                max_bytes=PAGED_KV_CACHE_BYTES,
+                block_size=KV_BLOCK_SIZE,
+                dtype=vl_gpt.dtype,
+                device=vl_gpt.device,
             )
+            if PAGED_KV_CACHE_BYTES > 0
+            else None
+        ),
+        name="caption-engine",
+    )
+
+
+def submit_to_engine(job: CaptionJob, **kwargs) -> Future:
+    """Queue a prepared job on the caption engine."""
+    return caption_engine.submit(
+        job,
+        job.max_new_tokens,
+        prefix_ids=text_prefix(job.prepared.input_ids.tolist(), vl_chat_processor.image_id),
+        **kwargs,
+    )
+
+
+caption_cache: Optional[CaptionCache] = None
+if CAPTION_CACHE_SIZE > 0:
+    caption_cache = CaptionCache(
+        max_entries=CAPTION_CACHE_SIZE,
+        ttl=float(CAPTION_CACHE_TTL) if CAPTION_CACHE_TTL else None,
+        disk_path=(
+            os.path.join(CAPTION_CACHE_DIR, "captions.sqlite")
+            if CAPTION_CACHE_DIR
+            else None
+        ),
+        max_disk_entries=CAPTION_CACHE_DISK_SIZE,
+    )
+
+
+def lookup_caption(job: CaptionJob):
+    """Returns the cache key of the job and its cached caption, if any."""
+    key = CaptionCache.make_key(job.image, job.prompt, job.max_new_tokens, CHECKPOINT_PATH)
+    return key, caption_cache.get(key)
+
+
+@app.on_event("startup")
+async def start_caption_batcher():
+    caption_batcher.start()
+    if caption_engine is not None:
+        caption_engine.start()
 
-        response = tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
+
+@app.on_event("shutdown")
+async def stop_inference_workers():
+    caption_batcher.stop()
+    if caption_engine is not None:
+        caption_engine.stop()
+    translation_executor.shutdown(wait=True)
+    preprocess_executor.shutdown(wait=True)
+
+
+async def submit_caption(image: Image.Image, prompt: str, max_new_tokens: int) -> str:
+    job = CaptionJob(image=image, prompt=prompt, max_new_tokens=max_new_tokens)
+
+    # Hashing the pixels is CPU-bound, keep it off the event loop
+    if caption_cache is not None:
+        key, caption = await run_in_threadpool(lookup_caption, job)
+        if caption is not None:
+            return caption
+
+    # Preprocess off the batcher thread, then queue the ready inputs, they are
+    # captioned together with the concurrent requests
+    await prepare_job(job)
+    if caption_engine is not None:
+        output_ids = await asyncio.wrap_future(submit_to_engine(job))
+        caption = tokenizer.decode(output_ids, skip_special_tokens=True)
+    else:
+        caption = await asyncio.wrap_future(caption_batcher.submit(job))
+
+    if caption_cache is not None:
+        await run_in_threadpool(caption_cache.put, key, caption)
+    return caption
+
+
+@app.post("/v1/caption", response_model=CaptionResponse)
+async def generate_caption(request: ImageRequest):
+    try:
+        # Decode the image off the event loop
+        image = await run_in_preprocess_executor(process_base64_image, request.image)
+
+        response = await submit_caption(image, request.prompt, request.max_new_tokens)
         return CaptionResponse(caption=response)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def parse_max_new_tokens(value) -> int:
+    """The `max_new_tokens` of a form field or query parameter, a positive integer."""
+    try:
+        max_new_tokens = int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=400, detail="`max_new_tokens` should be an integer"
+        )
+    if max_new_tokens <= 0:
+        raise HTTPException(
+            status_code=400, detail="`max_new_tokens` should be positive"
+        )
+    return max_new_tokens
+
+
+@app.post("/v1/caption/upload", response_model=CaptionResponse)
+async def generate_caption_upload(
+    request: Request,
+    prompt: str = DEFAULT_CAPTION_PROMPT,
+    max_new_tokens: int = 128,
+):
+    """
+    Caption raw image bytes, without the base64 encoding of /v1/caption.
+
+    Accepts either `multipart/form-data` with the image in the `image` field (and
+    optional `prompt` / `max_new_tokens` fields), or the image file itself as the
+    request body with an `application/octet-stream` or `image/*` content type (with
+    `prompt` / `max_new_tokens` as query parameters).
+    """
+    content_type = request.headers.get("content-type", "")
+    try:
+        max_new_tokens = parse_max_new_tokens(max_new_tokens)
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("image")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(
+                    status_code=400, detail="Missing `image` file field in form data"
+                )
+            prompt = form.get("prompt", prompt)
+            max_new_tokens = parse_max_new_tokens(
+                form.get("max_new_tokens", max_new_tokens)
+            )
+            image_file = upload.file
+
+        elif content_type.startswith(("application/octet-stream", "image/")):
+            # Stream the body into one buffer instead of materializing a JSON payload
+            image_file = BytesIO()
+            async for chunk in request.stream():
+                image_file.write(chunk)
+                if MAX_IMAGE_BYTES and image_file.tell() > MAX_IMAGE_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Image file exceeds the limit of {MAX_IMAGE_BYTES} bytes",
+                    )
+            image_file.seek(0)
+
+        else:
+            raise HTTPException(
+                status_code=415,
+                detail="Expected multipart/form-data, application/octet-stream or image/* body",
+            )
+
+        image = await run_in_preprocess_executor(process_image_file, image_file)
+
+        response = await submit_caption(image, prompt, max_new_tokens)
+        return CaptionResponse(caption=response)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/v1/caption/stream")
+async def generate_caption_stream(request: ImageRequest):
+    """
+    Caption an image and stream the text as Server-Sent Events while it is generated.
+
+    Each event carries `{"text": ...}` with the next piece of the caption, the stream
+    ends with a `done` event (or an `error` event). When the client disconnects the
+    generation is stopped and the model is released for the next requests.
+
+    Without the engine the stream is one row of a caption batch, like the other
+    requests, and stops on its own when cancelled.
+    """
+    # Decode the image off the event loop, before the stream starts
+    image = await run_in_preprocess_executor(process_base64_image, request.image)
+
+    job = CaptionJob(
+        image=image, prompt=request.prompt, max_new_tokens=request.max_new_tokens
+    )
+
+    if caption_cache is not None:
+        key, caption = await run_in_threadpool(lookup_caption, job)
+        if caption is not None:
+
+            async def cached_events():
+                yield f"data: {json.dumps({'text': caption})}\n\n"
+                yield "event: done\ndata: {}\n\n"
+
+            return StreamingResponse(cached_events(), media_type="text/event-stream")
+
+    await prepare_job(job)
+
+    # the text is awaited on the event loop, not in a worker thread per stream
+    streamer = AsyncTextStreamer(
+        tokenizer,
+        asyncio.get_running_loop(),
+        skip_prompt=True,
+        skip_special_tokens=True,
+    )
+    cancel_event = threading.Event()
+    if caption_engine is not None:
+        future = submit_to_engine(job, streamer=streamer, cancel_event=cancel_event)
+    else:
+        job.streamer, job.cancel_event = streamer, cancel_event
+        future = caption_batcher.submit(job)
+
+    async def events():
+        try:
+            pieces = []
+            async for text in streamer:
+                pieces.append(text)
+                yield f"data: {json.dumps({'text': text})}\n\n"
+
+            await asyncio.wrap_future(future)
+            if caption_cache is not None:
+                await run_in_threadpool(caption_cache.put, key, "".join(pieces))
+            yield "event: done\ndata: {}\n\n"
+
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+        finally:
+            finish()
+
+    def finish():
+        # stop the generation if the client went away, or drop it if it never started
+        cancel_event.set()
+        if future.cancel():
+            streamer.end()
+
+    # also run when the client disconnects before `events` is started
+    return StreamingResponse(
+        events(), media_type="text/event-stream", background=BackgroundTask(finish)
+    )
+
+
+@app.post("/v1/caption/batch", response_model=BatchCaptionResponse)
+async def generate_caption_batch(request: BatchCaptionRequest):
+    """
+    Caption many images in one call. The images go through the caption batcher,
+    which runs them on the model in chunks of at most MAX_BATCH_SIZE. Results keep
+    the order of the request, and a failing image only fails its own result.
+
+    At most BATCH_IN_FLIGHT_IMAGES images of all the batch requests are decoded and
+    waiting on the model at once, the next ones are decoded as they finish.
+    """
+
+    if MAX_BATCH_REQUEST_IMAGES and len(request.images) > MAX_BATCH_REQUEST_IMAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{len(request.images)} images exceed the limit of "
+            f"{MAX_BATCH_REQUEST_IMAGES} images per request",
+        )
+
+    async def caption_one(item: ImageRequest) -> BatchCaptionResult:
+        try:
+            async with batch_in_flight:
+                image = await run_in_preprocess_executor(
+                    process_base64_image, item.image
+                )
+                caption = await submit_caption(image, item.prompt, item.max_new_tokens)
+            return BatchCaptionResult(caption=caption)
+        except HTTPException as e:
+            return BatchCaptionResult(error=e.detail)
+        except Exception as e:
+            return BatchCaptionResult(error=str(e))
+
+    results = await asyncio.gather(*[caption_one(item) for item in request.images])
+    return BatchCaptionResponse(results=results)
+
+
+@app.get("/v1/caption/cache/stats")
+async def caption_cache_stats():
+    if caption_cache is None:
+        return {"enabled": False}
+    stats = await run_in_threadpool(caption_cache.stats)
+    return {"enabled": True, **stats}
+
+
+@app.get("/v1/caption/engine/stats")
+async def caption_engine_stats():
+    if caption_engine is None:
+        return {"enabled": False}
+    return {"enabled": True, **caption_engine.stats()}
+
+
+@app.get("/v1/caption/prefix_cache/stats")
+async def prefix_cache_stats():
+    if prefix_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **prefix_cache.stats()}
+
+
+@app.get("/v1/caption/speculative/stats")
+async def speculative_decoding_stats():
+    if draft_vl_gpt is None and phrase_trie is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "proposer": "draft_model" if draft_vl_gpt is not None else "prompt_lookup",
+        "num_speculative_tokens": NUM_SPECULATIVE_TOKENS,
+        **speculative_stats.stats(),
+        **({"phrase_trie": phrase_trie.stats()} if phrase_trie is not None else {}),
+    }
+
+
 @app.post("/v1/translation", response_model=TranslationResponse)
 async def translate_prompt(request: TranslationRequest):
     try:
-        language, translation = translate_text(request.prompt)
+        loop = asyncio.get_running_loop()
+        language, translation = await loop.run_in_executor(
+            translation_executor, translate_text, request.prompt
+        )
         return TranslationResponse(
             language=language,
             translation=translation
@@ -17,16 +17,32 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Literal, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
-import torchvision.transforms
+import torch.nn.functional as F
 from einops import rearrange
 
 from deepseek_vl.models.sam import create_sam_vit
 from deepseek_vl.models.siglip_vit import create_siglip_vit
 
+# worker thread running the low-res tower next to the high-res one on CPU
+_low_res_executor: Optional[ThreadPoolExecutor] = None
+_low_res_executor_lock = threading.Lock()
+
+
+def _get_low_res_executor() -> ThreadPoolExecutor:
+    global _low_res_executor
+    with _low_res_executor_lock:
+        if _low_res_executor is None:
+            _low_res_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="vision-tower-low"
+            )
+    return _low_res_executor
+
 
 class CLIPVisionTower(nn.Module):
     def __init__(
@@ -59,14 +75,15 @@ class CLIPVisionTower(nn.Module):
             vision_tower_params
         )
 
+        # (x - mean) / std, folded into a single x * scale + bias
         if pixel_mean is not None and pixel_std is not None:
-            image_norm = torchvision.transforms.Normalize(
-                mean=pixel_mean, std=pixel_std
-            )
+            pixel_mean = torch.tensor(pixel_mean, dtype=torch.float32).view(-1, 1, 1)
+            pixel_std = torch.tensor(pixel_std, dtype=torch.float32).view(-1, 1, 1)
+            self.register_buffer("norm_scale", 1.0 / pixel_std, persistent=False)
+            self.register_buffer("norm_bias", -pixel_mean / pixel_std, persistent=False)
         else:
-            image_norm = None
-
-        self.image_norm = image_norm
+            self.norm_scale = None
+            self.norm_bias = None
 
     def build_vision_tower(self, vision_tower_params):
         if self.model_name.startswith("siglip"):
@@ -105,18 +122,36 @@ class CLIPVisionTower(nn.Module):
             raise ValueError(f"Unexpected select feature: {self.select_feature}")
         return image_features
 
-    def forward(self, images):
+    def normalize(self, images: torch.Tensor) -> torch.Tensor:
+        """
+
+        Args:
+            images (torch.Tensor): [b, 3, H, W] in [0, 1]
+
+        Returns:
+            images (torch.Tensor): [b, 3, H, W] normalized with pixel_mean and pixel_std
+        """
+
+        if self.norm_scale is None:
+            return images
+
+        return torch.addcmul(
+            self.norm_bias.to(images.dtype), images, self.norm_scale.to(images.dtype)
+        )
+
+    def forward(self, images, normalized: bool = False):
         """
 
         Args:
             images (torch.Tensor): [b, 3, H, W]
+            normalized (bool): the images are already normalized, e.g. by HybridVisionTower
 
         Returns:
             image_features (torch.Tensor): [b, n_patch, d]
         """
 
-        if self.image_norm is not None:
-            images = self.image_norm(images)
+        if not normalized:
+            images = self.normalize(images)
 
         image_forward_outs = self.vision_tower(images, **self.forward_kwargs)
         image_features = self.feature_select(image_forward_outs)
@@ -131,14 +166,23 @@ class HybridVisionTower(nn.Module):
         freeze_high: bool = False,
         freeze_low: bool = False,
         concat_type: Literal["feature", "sequence", "add", "tuple"] = "tuple",
+        concurrent_towers: bool = False,
         **ignore_kwargs,
     ):
+        """
+
+        Args:
+            concurrent_towers (bool): run the high-res and low-res towers concurrently, on a
+                side CUDA stream for GPU inputs and on a worker thread for CPU inputs.
+        """
         super().__init__()
 
         self.vision_tower_high = CLIPVisionTower(**high_res_cfg)
         self.vision_tower_low = CLIPVisionTower(**low_res_cfg)
         self.low_res_size = low_res_cfg["image_size"]
         self.concat_type = concat_type
+        self.concurrent_towers = concurrent_towers
+        self._low_res_streams = {}
 
         self.high_layer_norm = nn.LayerNorm(high_res_cfg.get("output_dim", 1024))
         self.low_layer_norm = nn.LayerNorm(low_res_cfg.get("output_dim", 1024))
@@ -160,7 +204,41 @@ class HybridVisionTower(nn.Module):
                 p.requires_grad = False
             self.vision_tower_low = self.vision_tower_low.eval()
 
-        self.resize = torchvision.transforms.Resize(self.low_res_size, antialias=True)
+    def prepare_inputs(self, images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Build the inputs of both towers in one step: the high-res images are normalized with a
+        single fused multiply-add, the low-res images are resized with antialiased bilinear
+        interpolation and normalized the same way.
+
+        Args:
+            images (torch.Tensor): [bs, 3, H, W] in [0, 1]
+
+        Returns:
+            high_images (torch.Tensor): [bs, 3, H, W]
+            low_images (torch.Tensor): [bs, 3, h_low, w_low]
+        """
+
+        height, width = images.shape[-2:]
+        if isinstance(self.low_res_size, int):
+            # resize the shorter edge, as torchvision.transforms.Resize does
+            short, long = min(height, width), max(height, width)
+            long = int(self.low_res_size * long / short)
+            size = (
+                (self.low_res_size, long)
+                if height <= width
+                else (long, self.low_res_size)
+            )
+        else:
+            size = tuple(self.low_res_size)
+
+        low_images = F.interpolate(
+            images, size=size, mode="bilinear", align_corners=False, antialias=True
+        )
+
+        high_images = self.vision_tower_high.normalize(images)
+        low_images = self.vision_tower_low.normalize(low_images)
+
+        return high_images, low_images
 
     def forward(self, images: torch.Tensor):
         """
@@ -172,19 +250,20 @@ class HybridVisionTower(nn.Module):
             res (torch.Tensor): [bs, t, c]
         """
 
-        # [bs, c, h, w]
-        high_images = images
+        # [bs, c, h, w], [bs, c, h_low, w_low]
+        high_images, low_images = self.prepare_inputs(images)
 
-        # [bs, c, h_low, w_low]
-        low_images = self.resize(images)
+        if self.concurrent_towers:
+            high_res, low_res = self.run_towers_concurrently(high_images, low_images)
+        else:
+            # separately run two vision towers
+            # run high_res vision tower
+            high_res = self.vision_tower_high(high_images, normalized=True)
+            # run low_res vision tower
+            low_res = self.vision_tower_low(low_images, normalized=True)
 
-        # separately run two vision towers
-        # run high_res vision tower
-        high_res = self.vision_tower_high(high_images)
         # [bs, c, h, w] -> [bs, h*w, c]
         high_res = rearrange(high_res, "b c h w -> b (h w) c")
-        # run low_res vision tower
-        low_res = self.vision_tower_low(low_images)
 
         if self.concat_type == "feature":
             images_features = torch.cat([high_res, low_res], dim=-1)
@@ -202,10 +281,68 @@ class HybridVisionTower(nn.Module):
 
         return images_features
 
+    def run_towers_concurrently(
+        self, high_images: torch.Tensor, low_images: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The two towers do not depend on each other. On CUDA, the low-res tower is queued on a
+        side stream so its kernels overlap with the high-res ones. On CPU, it runs on a worker
+        thread while the calling thread runs the high-res tower.
+
+        Args:
+            high_images (torch.Tensor): [bs, 3, H, W], normalized
+            low_images (torch.Tensor): [bs, 3, h_low, w_low], normalized
+
+        Returns:
+            high_res (torch.Tensor): [bs, c, h, w]
+            low_res (torch.Tensor): [bs, t, c]
+        """
+
+        if low_images.is_cuda:
+            device = low_images.device
+            main_stream = torch.cuda.current_stream(device)
+            side_stream = self._low_res_streams.get(device)
+            if side_stream is None:
+                side_stream = torch.cuda.Stream(device)
+                self._low_res_streams[device] = side_stream
+
+            side_stream.wait_stream(main_stream)
+            with torch.cuda.stream(side_stream):
+                low_res = self.vision_tower_low(low_images, normalized=True)
+            # low_images was allocated on the main stream
+            low_images.record_stream(side_stream)
+
+            high_res = self.vision_tower_high(high_images, normalized=True)
+
+            main_stream.wait_stream(side_stream)
+            low_res.record_stream(main_stream)
+            return high_res, low_res
+
+        # grad mode and inference mode are thread local
+        grad_enabled = torch.is_grad_enabled()
+        inference_mode = torch.is_inference_mode_enabled()
+
+        def run_low():
+            with torch.inference_mode(inference_mode), torch.set_grad_enabled(
+                grad_enabled
+            ):
+                return self.vision_tower_low(low_images, normalized=True)
+
+        low_future = _get_low_res_executor().submit(run_low)
+        try:
+            high_res = self.vision_tower_high(high_images, normalized=True)
+        finally:
+            low_res = low_future.result()
+        return high_res, low_res
+
 
 if __name__ == "__main__":
+    import time
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
     image_size = 1024
-    x = torch.zeros(2, 3, image_size, image_size).bfloat16().cuda()
+    x = torch.zeros(2, 3, image_size, image_size).to(device=device, dtype=dtype)
 
     high_res_cfg = dict(
         model_name="sam_b_downsample",
@@ -235,8 +372,74 @@ if __name__ == "__main__":
             freeze_low=True,
             concat_type="tuple",
         )
-        .bfloat16()
-        .cuda()
+        .to(device=device, dtype=dtype)
+        .eval()
     )
-    high_x, low_x = net(x)
+    with torch.no_grad():
+        high_x, low_x = net(x)
     print(x.shape, high_x.shape, low_x.shape)
+
+    # serial vs concurrent towers
+    x = torch.randn(1, 3, image_size, image_size).to(device=device, dtype=dtype)
+    outputs = {}
+    for concurrent_towers in (False, True):
+        net.concurrent_towers = concurrent_towers
+        with torch.no_grad():
+            outputs[concurrent_towers] = net(x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(3):
+                net(x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / 3 * 1000
+        print(f"concurrent_towers={concurrent_towers}: {elapsed:.1f} ms/image")
+
+    for serial, concurrent in zip(outputs[False], outputs[True]):
+        assert torch.equal(serial, concurrent)
+
+    # bytes moved to build the inputs of both towers, per image
+    import torchvision.transforms
+    from torch.utils._python_dispatch import TorchDispatchMode
+    from torch.utils._pytree import tree_flatten
+
+    class BytesMoved(TorchDispatchMode):
+        def __init__(self):
+            super().__init__()
+            self.bytes = 0
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            out = func(*args, **(kwargs or {}))
+            if not func.is_view:
+                for t in tree_flatten((args, kwargs, out))[0]:
+                    if isinstance(t, torch.Tensor):
+                        self.bytes += t.numel() * t.element_size()
+            return out
+
+    def unfused_prepare_inputs(images):
+        low_images = torchvision.transforms.Resize(net.low_res_size, antialias=True)(
+            images
+        )
+        high_norm = torchvision.transforms.Normalize(
+            mean=high_res_cfg["pixel_mean"], std=high_res_cfg["pixel_std"]
+        )
+        low_norm = torchvision.transforms.Normalize(
+            mean=low_res_cfg["pixel_mean"], std=low_res_cfg["pixel_std"]
+        )
+        return high_norm(images), low_norm(low_images)
+
+    x = torch.rand(1, 3, image_size, image_size).to(device=device, dtype=dtype)
+    for name, prepare in [
+        ("unfused", unfused_prepare_inputs),
+        ("fused", net.prepare_inputs),
+    ]:
+        with torch.no_grad():
+            with BytesMoved() as counter:
+                high_x, low_x = prepare(x)
+            if name == "unfused":
+                expected = (high_x, low_x)
+            else:
+                for a, b in zip(expected, (high_x, low_x)):
+                    print(f"  max abs diff = {(a - b).abs().max().item():.3e}")
+        print(f"{name}: {counter.bytes / 2**20:.1f} MiB moved per image")
@@ -17,13 +17,12 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from typing import List, Tuple, Union
+from io import BytesIO
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import torch
-import torchvision
-import torchvision.transforms.functional
-from PIL import Image
+from PIL import Image, ImageFilter
 from transformers import AutoImageProcessor, PretrainedConfig
 from transformers.image_processing_utils import BaseImageProcessor, BatchFeature
 from transformers.image_utils import to_numpy_array
@@ -38,6 +37,80 @@ IMAGENET_INCEPTION_MEAN = (0.5, 0.5, 0.5)
 IMAGENET_INCEPTION_STD = (0.5, 0.5, 0.5)
 
 
+# Decode / shrink images to at least this many times the target size before the final
+# bicubic resize, as PIL.Image.thumbnail does
+REDUCING_GAP = 2.0
+
+
+def draft_image(
+    image: Image.Image, max_size: Optional[int] = None, max_pixels: Optional[int] = None
+) -> Image.Image:
+    """
+    Let the JPEG decoder skip the full resolution decode of an image much larger than needed.
+    The DCT scaling of the decoder reduces by 2, 4 or 8, keeping at least REDUCING_GAP times the
+    size of the final resize. It is a no-op for other formats and already decoded images.
+
+    Args:
+        image (PIL.Image): an opened, not yet loaded, image.
+        max_size (Optional[int]): the size of the longer side the image will be resized to.
+        max_pixels (Optional[int]): reduce further, as far as the decoder can, until the decoded
+            image has at most this many pixels.
+
+    Returns:
+        pil_img (PIL.Image): the same image object, check its size for the decoded size.
+    """
+
+    if image.format != "JPEG":
+        return image
+
+    width, height = image.size
+    scale = 1
+    if max_size is not None:
+        while scale < 8 and max(width, height) / (scale * 2) >= max_size * REDUCING_GAP:
+            scale *= 2
+    if max_pixels is not None:
+        while scale < 8 and (width / scale) * (height / scale) > max_pixels:
+            scale *= 2
+
+    if scale > 1:
+        image.draft(None, (max(width // scale, 1), max(height // scale, 1)))
+    return image
+
+
+def to_pil_image(
+    image: Union[ImageType, bytes], max_size: Optional[int] = None
+) -> Image.Image:
+    """
+
+    Args:
+        image (Union[ImageType, bytes]): a PIL image, the encoded bytes of an image file, a
+            binary file object, or a uint8 array / tensor of shape [H, W], [H, W, 3] or [H, W, 4].
+        max_size (Optional[int]): the size of the longer side the image will be resized to, large
+            JPEG files are decoded at a reduced scale, see draft_image.
+
+    Returns:
+        pil_img (PIL.Image): the image in RGB.
+    """
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(BytesIO(image))
+    elif hasattr(image, "read"):
+        image = Image.open(image)
+    elif isinstance(image, torch.Tensor):
+        image = Image.fromarray(image.cpu().numpy())
+    elif isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    elif not isinstance(image, Image.Image):
+        raise TypeError(f"Unsupported image type: {type(image)}")
+
+    if max_size is not None:
+        image = draft_image(image, max_size)
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
 def expand2square(pil_img, background_color):
     width, height = pil_img.size
     if width == height:
@@ -108,6 +181,7 @@ class VLMImageProcessor(BaseImageProcessor):
         ),
         rescale_factor: float = 1.0 / 255.0,
         do_normalize: bool = True,
+        reducing_gap: Optional[float] = REDUCING_GAP,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -118,20 +192,21 @@ class VLMImageProcessor(BaseImageProcessor):
         self.image_std = image_std
         self.min_size = min_size
         self.do_normalize = do_normalize
+        self.reducing_gap = reducing_gap
 
         if image_mean is None:
             self.background_color = (127, 127, 127)
         else:
             self.background_color = tuple([int(x * 255) for x in image_mean])
 
-    def resize(self, pil_img: Image) -> np.ndarray:
+    def resize_keep_ratio(self, pil_img: Image) -> Image:
         """
 
         Args:
             pil_img (PIL.Image): [H, W, 3] in PIL.Image in RGB
 
         Returns:
-            x (np.ndarray): [3, self.image_size, self.image_size]
+            pil_img (PIL.Image): resized so that its longer side is self.image_size
         """
 
         width, height = pil_img.size
@@ -146,13 +221,27 @@ class VLMImageProcessor(BaseImageProcessor):
             print(f"orig size = {pil_img.size}, new size = {size}")
             raise ValueError("Invalid size!")
 
-        pil_img = torchvision.transforms.functional.resize(
-            pil_img,
-            size,
-            interpolation=torchvision.transforms.functional.InterpolationMode.BICUBIC,
-            antialias=True,
+        # PIL always antialiases, reducing_gap first shrinks by an integer factor with a cheap
+        # box filter and only runs the bicubic filter on the last REDUCING_GAP x steps
+        pil_img = pil_img.resize(
+            (size[1], size[0]),
+            Image.Resampling.BICUBIC,
+            reducing_gap=self.reducing_gap,
         )
 
+        return pil_img
+
+    def resize(self, pil_img: Image) -> np.ndarray:
+        """
+
+        Args:
+            pil_img (PIL.Image): [H, W, 3] in PIL.Image in RGB
+
+        Returns:
+            x (np.ndarray): [3, self.image_size, self.image_size]
+        """
+
+        pil_img = self.resize_keep_ratio(pil_img)
         pil_img = expand2square(pil_img, self.background_color)
         x = to_numpy_array(pil_img)
 
@@ -161,34 +250,60 @@ class VLMImageProcessor(BaseImageProcessor):
 
         return x
 
-    def preprocess(self, images, return_tensors: str = "pt", **kwargs) -> BatchFeature:
-        # resize and pad to [self.image_size, self.image_size]
-        # then convert from [H, W, 3] to [3, H, W]
-        images: List[np.ndarray] = [self.resize(image) for image in images]
-
-        # resacle from [0, 255] -> [0, 1]
-        images = [
-            self.rescale(
-                image=image,
-                scale=self.rescale_factor,
-                input_data_format="channels_first",
-            )
-            for image in images
-        ]
+    def preprocess_batch(
+        self,
+        images: List[Union[ImageType, bytes]],
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """
+        Resize every image in PIL, paste it centered into one pre-allocated uint8 buffer filled
+        with the background color, then rescale and normalize the whole batch with a single
+        affine op computed in the target dtype.
+
+        Args:
+            images (List[Union[ImageType, bytes]]): the images, see to_pil_image.
+            dtype (torch.dtype): dtype of the returned pixel values, e.g. torch.bfloat16.
+
+        Returns:
+            pixel_values (torch.Tensor): [N, 3, self.image_size, self.image_size]
+        """
 
-        # normalize
+        size = self.image_size
+        batch = torch.empty((len(images), 3, size, size), dtype=torch.uint8)
+        batch[:] = torch.tensor(self.background_color, dtype=torch.uint8).view(3, 1, 1)
+
+        for i, image in enumerate(images):
+            pil_img = self.resize_keep_ratio(to_pil_image(image, max_size=size))
+            width, height = pil_img.size
+            # same placement as expand2square
+            top, left = (size - height) // 2, (size - width) // 2
+            # [H, W, 3] -> [3, H, W]
+            pixels = torch.from_numpy(np.array(pil_img)).permute(2, 0, 1)
+            batch[i, :, top : top + height, left : left + width] = pixels
+
+        # x * rescale_factor, then (x - mean) / std, as x * scale + bias
+        scale = torch.full((3, 1, 1), self.rescale_factor, dtype=torch.float32)
+        bias = torch.zeros((3, 1, 1), dtype=torch.float32)
         if self.do_normalize:
-            images = [
-                self.normalize(
-                    image=image,
-                    mean=self.image_mean,
-                    std=self.image_std,
-                    input_data_format="channels_first",
-                )
-                for image in images
-            ]
-
-        data = {"pixel_values": images}
+            mean = torch.tensor(self.image_mean, dtype=torch.float32).view(3, 1, 1)
+            std = torch.tensor(self.image_std, dtype=torch.float32).view(3, 1, 1)
+            scale = scale / std
+            bias = -mean / std
+
+        # the affine runs in place in float32 and is rounded once to the target dtype, applying
+        # it directly in bfloat16 would round twice
+        pixel_values = torch.empty(batch.shape, dtype=torch.float32).copy_(batch)
+        pixel_values.mul_(scale).add_(bias)
+        return pixel_values.to(dtype)
+
+    def preprocess(self, images, return_tensors: str = "pt", **kwargs) -> BatchFeature:
+        # resize and pad to [self.image_size, self.image_size] in [3, H, W],
+        # then rescale from [0, 255] -> [0, 1] and normalize
+        pixel_values = self.preprocess_batch(
+            images, dtype=kwargs.get("dtype", torch.float32)
+        )
+
+        data = {"pixel_values": pixel_values}
         return BatchFeature(data=data, tensor_type=return_tensors)
 
     @property
@@ -206,3 +321,66 @@ if __name__ == "__main__":
         image_std=IMAGENET_INCEPTION_STD,
         do_normalize=True,
     )
+
+    # per-image numpy path vs batched torch path
+    import time
+
+    images = [
+        Image.fromarray(np.random.randint(0, 256, (768, 1280, 3), dtype=np.uint8))
+        for _ in range(8)
+    ]
+
+    def numpy_preprocess(images):
+        pixel_values = []
+        for image in images:
+            x = image_processor.resize(image)
+            x = image_processor.rescale(
+                image=x,
+                scale=image_processor.rescale_factor,
+                input_data_format="channels_first",
+            )
+            x = image_processor.normalize(
+                image=x,
+                mean=image_processor.image_mean,
+                std=image_processor.image_std,
+                input_data_format="channels_first",
+            )
+            pixel_values.append(x)
+        return torch.tensor(np.stack(pixel_values))
+
+    for name, fn in [
+        ("numpy", numpy_preprocess),
+        ("batch fp32", lambda x: image_processor.preprocess_batch(x)),
+        (
+            "batch bf16",
+            lambda x: image_processor.preprocess_batch(x, dtype=torch.bfloat16),
+        ),
+    ]:
+        start = time.perf_counter()
+        pixel_values = fn(images)
+        elapsed = (time.perf_counter() - start) / len(images) * 1000
+        if name == "numpy":
+            expected = pixel_values
+        diff = (pixel_values.float() - expected).abs().max().item()
+        print(f"{name}: {elapsed:.1f} ms/image, max abs diff = {diff:.3e}")
+
+    # full resolution vs draft mode decode of a large JPEG
+    jpeg = BytesIO()
+    Image.fromarray(np.random.randint(0, 256, (4000, 6000, 3), dtype=np.uint8)).filter(
+        ImageFilter.GaussianBlur(4)
+    ).save(jpeg, "JPEG", quality=90)
+    jpeg = jpeg.getvalue()
+
+    for max_size, reducing_gap in [(None, None), (image_processor.image_size, 2.0)]:
+        image_processor.reducing_gap = reducing_gap
+        start = time.perf_counter()
+        pil_img = to_pil_image(jpeg, max_size=max_size)
+        pil_img.load()
+        decoded = time.perf_counter()
+        image_processor.resize(pil_img)
+        resized = time.perf_counter()
+        print(
+            f"max_size={max_size}: decoded {pil_img.size} "
+            f"({pil_img.width * pil_img.height * 3 / 2**20:.1f} MiB) in "
+            f"{(decoded - start) * 1000:.1f} ms, resized in {(resized - decoded) * 1000:.1f} ms"
+        )
@@ -0,0 +1,141 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+
+
+def hash_images(images: torch.Tensor) -> List[str]:
+    """
+
+    Args:
+        images (torch.Tensor): [n, 3, H, W] pixel values.
+
+    Returns:
+        keys (List[str]): one content hash per image, equal images get equal keys.
+    """
+
+    # hash the raw bytes, independently of the dtype and of the device
+    raw = images.detach().contiguous().view(images.shape[0], -1)
+    raw = raw.view(torch.uint8).cpu().numpy()
+    prefix = f"{images.dtype}{tuple(images.shape[1:])}".encode("utf-8")
+
+    keys = []
+    for row in raw:
+        h = hashlib.blake2b(prefix, digest_size=16)
+        h.update(row.data)
+        keys.append(h.hexdigest())
+    return keys
+
+
+class ImagesEmbedsCache(object):
+    """
+    LRU cache of the aligner outputs of `MultiModalityCausalLM`, keyed by the content
+    hash of the pixel values.
+
+    Recently used embeddings stay on the model's device within `max_device_bytes`.
+    Older ones spill to host memory within `max_host_bytes`, and move back to the
+    device on their next hit. Entries are dropped once both budgets are full.
+
+    The cache does not watch the weights: call `clear` after loading new ones.
+    """
+
+    def __init__(self, max_device_bytes: int = 1 << 30, max_host_bytes: int = 4 << 30):
+        self.max_device_bytes = max_device_bytes
+        self.max_host_bytes = max_host_bytes
+
+        self._device_entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._host_entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._device_bytes = 0
+        self._host_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, misses=0, spills=0, evictions=0)
+
+    def get(self, key: str, device: torch.device) -> Optional[torch.Tensor]:
+        with self._lock:
+            embeds = self._device_entries.get(key)
+            if embeds is not None:
+                self._device_entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return embeds
+
+            embeds = self._host_entries.pop(key, None)
+            if embeds is not None:
+                self._host_bytes -= _nbytes(embeds)
+                embeds = embeds.to(device, non_blocking=True)
+                self._insert(key, embeds)
+                self._counters["hits"] += 1
+                return embeds
+
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key: str, embeds: torch.Tensor):
+        with self._lock:
+            if key in self._device_entries or key in self._host_entries:
+                return
+            # copy, so a slice of a batch does not keep the whole batch alive
+            self._insert(key, embeds.detach().clone())
+
+    def _insert(self, key: str, embeds: torch.Tensor):
+        self._device_entries[key] = embeds
+        self._device_bytes += _nbytes(embeds)
+
+        # spill the least recently used embeddings to the host
+        while self._device_bytes > self.max_device_bytes and self._device_entries:
+            old_key, old_embeds = self._device_entries.popitem(last=False)
+            self._device_bytes -= _nbytes(old_embeds)
+            if _nbytes(old_embeds) > self.max_host_bytes:
+                self._counters["evictions"] += 1
+                continue
+
+            self._host_entries[old_key] = old_embeds.to("cpu")
+            self._host_bytes += _nbytes(old_embeds)
+            self._counters["spills"] += 1
+
+        while self._host_bytes > self.max_host_bytes and self._host_entries:
+            _, old_embeds = self._host_entries.popitem(last=False)
+            self._host_bytes -= _nbytes(old_embeds)
+            self._counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._device_entries.clear()
+            self._host_entries.clear()
+            self._device_bytes = 0
+            self._host_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(
+                device_entries=len(self._device_entries),
+                host_entries=len(self._host_entries),
+                device_bytes=self._device_bytes,
+                host_bytes=self._host_bytes,
+            )
+        return stats
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
@@ -17,6 +17,8 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from typing import List, Optional
+
 import torch
 from attrdict import AttrDict
 from einops import rearrange
@@ -30,6 +32,7 @@ from transformers import (
 from transformers.configuration_utils import PretrainedConfig
 
 from deepseek_vl.models.clip_encoder import CLIPVisionTower, HybridVisionTower
+from deepseek_vl.models.images_embeds_cache import ImagesEmbedsCache, hash_images
 from deepseek_vl.models.projector import MlpProjector
 
 
@@ -122,12 +125,92 @@ class MultiModalityCausalLM(MultiModalityPreTrainedModel):
         language_config = config.language_config
         self.language_model = LlamaForCausalLM(language_config)
 
+        self.images_embeds_cache: Optional[ImagesEmbedsCache] = None
+
+    def enable_images_embeds_cache(
+        self, max_device_bytes: int = 1 << 30, max_host_bytes: int = 4 << 30
+    ) -> ImagesEmbedsCache:
+        """
+        Reuse the aligner outputs of images that were already encoded, e.g. the earlier
+        images of a multi-turn chat, instead of running the vision towers again.
+
+        Args:
+            max_device_bytes (int): memory budget of the cached embeddings on the model's device.
+            max_host_bytes (int): memory budget of the embeddings spilled to host memory.
+
+        Returns:
+            cache (ImagesEmbedsCache): the cache used by `prepare_inputs_embeds`.
+        """
+
+        self.images_embeds_cache = ImagesEmbedsCache(
+            max_device_bytes=max_device_bytes, max_host_bytes=max_host_bytes
+        )
+        return self.images_embeds_cache
+
+    def disable_images_embeds_cache(self):
+        self.images_embeds_cache = None
+
+    def encode_images(
+        self, images: torch.Tensor, keys: Optional[List[str]] = None
+    ) -> torch.Tensor:
+        """
+        Runs the vision towers and the aligner once per distinct image: duplicated
+        images share one encoding, and cached images are not encoded at all.
+
+        The images are only hashed here, on their device, when the embeddings cache is
+        enabled and `keys` are not given: without the cache, only the images hashed on
+        the host by the processor are deduplicated.
+
+        Args:
+            images (torch.Tensor): [n, 3, h, w]
+            keys (List[str], optional): the content hash of every image, see
+                `VLChatProcessor.dedup_images`.
+
+        Returns:
+            images_embeds (torch.Tensor): [n, T2, D]
+        """
+
+        if keys is None:
+            if self.images_embeds_cache is None or images.shape[0] == 0:
+                return self.aligner(self.vision_model(images))
+            keys = hash_images(images)
+        elif self.images_embeds_cache is None and len(set(keys)) == len(keys):
+            return self.aligner(self.vision_model(images))
+
+        # position of every distinct image, in order of first appearance
+        unique_keys = list(dict.fromkeys(keys))
+        inverse = torch.tensor(
+            [unique_keys.index(key) for key in keys], device=images.device
+        )
+        first = [keys.index(key) for key in unique_keys]
+
+        if self.images_embeds_cache is None:
+            unique_embeds = self.aligner(self.vision_model(images[first]))
+            return unique_embeds[inverse]
+
+        cached = [
+            self.images_embeds_cache.get(key, images.device) for key in unique_keys
+        ]
+        missing = [i for i, embeds in enumerate(cached) if embeds is None]
+
+        if len(missing) > 0:
+            # only the images that are not cached go through the vision towers
+            missing_embeds = self.aligner(
+                self.vision_model(images[[first[i] for i in missing]])
+            )
+            for i, embeds in zip(missing, missing_embeds):
+                self.images_embeds_cache.put(unique_keys[i], embeds)
+                cached[i] = embeds
+
+        return torch.stack(cached, dim=0)[inverse]
+
     def prepare_inputs_embeds(
         self,
         input_ids: torch.LongTensor,
         pixel_values: torch.FloatTensor,
         images_seq_mask: torch.LongTensor,
         images_emb_mask: torch.LongTensor,
+        image_keys: Optional[List[str]] = None,
         **kwargs,
     ):
         """
@@ -137,6 +220,7 @@ class MultiModalityCausalLM(MultiModalityPreTrainedModel):
             pixel_values (torch.FloatTensor):   [b, n_images, 3, h, w]
             images_seq_mask (torch.BoolTensor): [b, T]
             images_emb_mask (torch.BoolTensor): [b, n_images, n_image_tokens]
+            image_keys (List[str], optional): the content hash of every image, in (b n) order.
 
             assert torch.sum(images_seq_mask) == torch.sum(images_emb_mask)
 
@@ -144,22 +228,24 @@ class MultiModalityCausalLM(MultiModalityPreTrainedModel):
             input_embeds (torch.Tensor): [b, T, D]
         """
 
-        bs, n = pixel_values.shape[0:2]
         images = rearrange(pixel_values, "b n c h w -> (b n) c h w")
-        # [b x n, T2, D]
-        images_embeds = self.aligner(self.vision_model(images))
-
-        # [b x n, T2, D] -> [b, n x T2, D]
-        images_embeds = rearrange(images_embeds, "(b n) t d -> b (n t) d", b=bs, n=n)
-        # [b, n, T2] -> [b, n x T2]
-        images_emb_mask = rearrange(images_emb_mask, "b n t -> b (n t)")
+        # [b, n, T2] -> [b x n, T2]
+        images_emb_mask = rearrange(images_emb_mask, "b n t -> (b n) t")
 
         # [b, T, D]
         input_ids[input_ids < 0] = 0  # ignore the image embeddings
         inputs_embeds = self.language_model.get_input_embeddings()(input_ids)
 
-        # replace with the image embeddings
-        inputs_embeds[images_seq_mask] = images_embeds[images_emb_mask]
+        # skip the zero-padding slots that batchify adds for shorter image lists
+        used = images_emb_mask.any(dim=-1)
+        if not used.any():
+            return inputs_embeds
+
+        # [n_used, T2, D]
+        images_embeds = self.encode_images(images[used], keys=image_keys)
+
+        # replace with the image embeddings, the (b n) order of the used slots is kept
+        inputs_embeds[images_seq_mask] = images_embeds[images_emb_mask[used]]
 
         return inputs_embeds
 
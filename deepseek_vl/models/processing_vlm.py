@@ -17,8 +17,10 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import math
+import threading
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
 from PIL.Image import Image
@@ -26,6 +28,7 @@ from transformers import LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
 
 from deepseek_vl.models.image_processing_vlm import VLMImageProcessor
+from deepseek_vl.models.images_embeds_cache import hash_images
 from deepseek_vl.utils.conversation import get_conv_template
 
 
@@ -46,11 +49,142 @@ class VLChatProcessorOutput(DictOutput):
     input_ids: torch.Tensor
     pixel_values: torch.Tensor
     num_image_tokens: torch.IntTensor
+    # content hash of every image, see VLChatProcessor.dedup_images
+    image_keys: Optional[List[str]] = None
 
     def __len__(self):
         return len(self.input_ids)
 
 
+# fields of a batch, packed in this order into one byte buffer
+STAGED_FIELDS = (
+    "pixel_values",
+    "input_ids",
+    "attention_mask",
+    "images_seq_mask",
+    "images_emb_mask",
+)
+
+
+def staging_layout(
+    fields: List[Tuple[str, torch.dtype, Tuple[int, ...]]],
+) -> Tuple[List[Tuple[str, torch.dtype, Tuple[int, ...], int]], int]:
+    """
+
+    Args:
+        fields (List[Tuple[str, torch.dtype, Tuple[int, ...]]]): name, dtype and shape of the
+            tensors packed into the buffer.
+
+    Returns:
+        layout (List[Tuple[str, torch.dtype, Tuple[int, ...], int]]): the fields with the byte
+            offset of each of them, aligned to 8 bytes.
+        nbytes (int): the size of the buffer.
+    """
+
+    layout, offset = [], 0
+    for name, dtype, shape in fields:
+        offset = (offset + 7) // 8 * 8
+        layout.append((name, dtype, shape, offset))
+        offset += math.prod(shape) * dtype.itemsize
+    return layout, offset
+
+
+def unpack_staging(
+    staging: torch.Tensor, layout: List[Tuple[str, torch.dtype, Tuple[int, ...], int]]
+) -> Dict[str, torch.Tensor]:
+    """
+
+    Args:
+        staging (torch.Tensor): the uint8 buffer.
+        layout (List[Tuple[str, torch.dtype, Tuple[int, ...], int]]): see staging_layout.
+
+    Returns:
+        views (Dict[str, torch.Tensor]): the typed views of the buffer, by name.
+    """
+
+    views = {}
+    for name, dtype, shape, offset in layout:
+        nbytes = math.prod(shape) * dtype.itemsize
+        views[name] = staging[offset : offset + nbytes].view(dtype).view(shape)
+    return views
+
+
+class BatchBufferPool(object):
+    """
+    Reusable host buffers for VLChatProcessor.batchify. Capacities are rounded up to powers of
+    two, so that batches of similar shapes reuse the buffers of the previous ones instead of
+    allocating, and page-faulting, new ones.
+    """
+
+    def __init__(self, max_free_buffers: int = 4):
+        """
+        Args:
+            max_free_buffers (int): the number of released buffers kept for reuse.
+        """
+
+        self.max_free_buffers = max_free_buffers
+
+        # (buffer, pinned, event of the last asynchronous copy out of it)
+        self._free: List[Tuple[torch.Tensor, bool, Optional[torch.cuda.Event]]] = []
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, misses=0)
+
+    def acquire(self, nbytes: int, pin_memory: bool = False) -> torch.Tensor:
+        """
+
+        Args:
+            nbytes (int): the size of the buffer.
+            pin_memory (bool): whether the buffer is in pinned memory.
+
+        Returns:
+            buffer (torch.Tensor): an uninitialized uint8 buffer of nbytes.
+        """
+
+        with self._lock:
+            best = None
+            for i, (buffer, pinned, event) in enumerate(self._free):
+                if buffer.numel() < nbytes or pinned != pin_memory:
+                    continue
+                if event is not None and not event.query():
+                    continue
+                if best is None or buffer.numel() < self._free[best][0].numel():
+                    best = i
+
+            if best is not None:
+                self._counters["hits"] += 1
+                return self._free.pop(best)[0][:nbytes]
+            self._counters["misses"] += 1
+
+        capacity = 1 << max(nbytes - 1, 0).bit_length()
+        buffer = torch.empty(capacity, dtype=torch.uint8, pin_memory=pin_memory)
+        return buffer[:nbytes]
+
+    def release(self, buffer: torch.Tensor, event: Optional[torch.cuda.Event] = None):
+        """
+
+        Args:
+            buffer (torch.Tensor): a buffer returned by acquire, it must not be used anymore.
+            event (Optional[torch.cuda.Event]): the buffer is only reused after this event,
+                recorded after an asynchronous copy out of the buffer.
+        """
+
+        if buffer._base is not None:
+            buffer = buffer._base
+
+        with self._lock:
+            self._free.append((buffer, buffer.is_pinned(), event))
+            if len(self._free) > self.max_free_buffers:
+                self._free.pop(0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                free_buffers=len(self._free),
+                free_bytes=sum(buffer.numel() for buffer, _, _ in self._free),
+                **self._counters,
+            )
+
+
 @dataclass
 class BatchedVLChatProcessorOutput(DictOutput):
     sft_format: List[str]
@@ -59,15 +193,72 @@ class BatchedVLChatProcessorOutput(DictOutput):
     attention_mask: torch.Tensor
     images_seq_mask: torch.BoolTensor
     images_emb_mask: torch.BoolTensor
+    # uint8 buffer all the tensors are views of, moved to the device in one copy
+    staging: Optional[torch.Tensor] = None
+    # the pool the host staging buffer is returned to once it has been copied
+    buffer_pool: Optional[BatchBufferPool] = None
+    # content hash of every image of the batch, in (b n) order
+    image_keys: Optional[List[str]] = None
+
+    def to(self, device, dtype=torch.bfloat16, non_blocking: Optional[bool] = None):
+        """
+
+        Args:
+            device: the target device.
+            dtype (torch.dtype): the dtype of the pixel values.
+            non_blocking (Optional[bool]): copy asynchronously, defaults to True when the batch
+                is in pinned memory.
+
+        Returns:
+            self, with the tensors on the device.
+        """
+
+        if non_blocking is None:
+            non_blocking = self.pixel_values.is_pinned()
+
+        if self.staging is not None and all(
+            self[name].untyped_storage().data_ptr()
+            == self.staging.untyped_storage().data_ptr()
+            for name in STAGED_FIELDS
+        ):
+            # one copy for the whole batch
+            staging = self.staging.to(device, non_blocking=non_blocking)
+            if staging is not self.staging:
+                layout, _ = staging_layout(
+                    [
+                        (name, self[name].dtype, tuple(self[name].shape))
+                        for name in STAGED_FIELDS
+                    ]
+                )
+                for name, view in unpack_staging(staging, layout).items():
+                    self[name] = view
+
+                event = None
+                if non_blocking and staging.is_cuda:
+                    event = torch.cuda.Event()
+                    event.record(torch.cuda.current_stream(staging.device))
+                self.release(event)
+                self.staging = staging
+
+            self.pixel_values = self.pixel_values.to(dtype=dtype)
+        else:
+            for name in STAGED_FIELDS:
+                self[name] = self[name].to(device, non_blocking=non_blocking)
+            self.pixel_values = self.pixel_values.to(dtype=dtype)
+            # some tensors may still be views of the buffer, leave it to the garbage collector
+            self.staging = None
+            self.buffer_pool = None
 
-    def to(self, device, dtype=torch.bfloat16):
-        self.input_ids = self.input_ids.to(device)
-        self.attention_mask = self.attention_mask.to(device)
-        self.images_seq_mask = self.images_seq_mask.to(device)
-        self.images_emb_mask = self.images_emb_mask.to(device)
-        self.pixel_values = self.pixel_values.to(device=device, dtype=dtype)
         return self
 
+    def release(self, event: Optional[torch.cuda.Event] = None):
+        """Return the host staging buffer to its pool, the batch must not use it anymore."""
+
+        if self.staging is not None and self.buffer_pool is not None:
+            self.buffer_pool.release(self.staging, event)
+        self.staging = None
+        self.buffer_pool = None
+
 
 class VLChatProcessor(ProcessorMixin):
     image_processor_class = "AutoImageProcessor"
@@ -81,6 +272,10 @@ class VLChatProcessor(ProcessorMixin):
         "and assist the user with a variety of tasks using natural language."
     )
 
+    # hash the pixel values in `process_one`, on the host, so that the model encodes
+    # the duplicated images of a batch once without hashing them on its device
+    dedup_images = False
+
     def __init__(
         self,
         image_processor: VLMImageProcessor,
@@ -188,13 +383,13 @@ class VLChatProcessor(ProcessorMixin):
 
     def add_image_token(
         self,
-        image_indices: List[int],
+        image_indices: Union[List[int], torch.LongTensor],
         input_ids: torch.LongTensor,
     ):
         """
 
         Args:
-            image_indices (List[int]): [index_0, index_1, ..., index_j]
+            image_indices (Union[List[int], torch.LongTensor]): [index_0, index_1, ..., index_j]
             input_ids (torch.LongTensor): [N]
 
         Returns:
@@ -202,30 +397,29 @@ class VLChatProcessor(ProcessorMixin):
             num_image_tokens (torch.IntTensor): [n_images]
         """
 
-        input_slices = []
-
-        start = 0
-        for index in image_indices:
-            if self.add_special_token:
-                end = index + 1
-            else:
-                end = index
-
-            # original text tokens
-            input_slices.append(input_ids[start:end])
-
-            # add image tokens, and set the mask as False
-            input_slices.append(
-                self.image_id * torch.ones((self.num_image_tokens,), dtype=torch.long)
-            )
-            start = index + 1
-
-        # the left part
-        input_slices.append(input_ids[start:])
+        image_indices = torch.as_tensor(image_indices, dtype=torch.long).reshape(-1)
+        n_images = len(image_indices)
+
+        # every placeholder becomes num_image_tokens tokens, after the placeholder itself
+        # when add_special_token is set
+        block_len = self.num_image_tokens + int(self.add_special_token)
+        repeats = torch.ones_like(input_ids)
+        repeats[image_indices] = block_len
+        output_size = len(input_ids) + n_images * (block_len - 1)
+        input_ids = torch.repeat_interleave(input_ids, repeats, output_size=output_size)
+
+        # the image tokens are the last num_image_tokens tokens of each block
+        block_ends = torch.cumsum(repeats, dim=0)[image_indices]
+        image_positions = (
+            block_ends[:, None]
+            - self.num_image_tokens
+            + torch.arange(self.num_image_tokens)[None, :]
+        )
+        input_ids[image_positions.reshape(-1)] = self.image_id
 
-        # concat all slices
-        input_ids = torch.cat(input_slices, dim=0)
-        num_image_tokens = torch.IntTensor([self.num_image_tokens] * len(image_indices))
+        num_image_tokens = torch.full(
+            (n_images,), self.num_image_tokens, dtype=torch.int
+        )
 
         return input_ids, num_image_tokens
 
@@ -241,7 +435,8 @@ class VLChatProcessor(ProcessorMixin):
         Args:
             prompt (str): the formatted prompt;
             conversations (List[Dict]): conversations with a list of messages;
-            images (List[ImageType]): the list of images;
+            images (List[ImageType]): the list of images, as PIL images, encoded image bytes
+                or uint8 arrays;
             **kwargs:
 
         Returns:
@@ -273,7 +468,7 @@ class VLChatProcessor(ProcessorMixin):
 
         # add image tokens to the input_ids
         image_token_mask: torch.BoolTensor = input_ids == self.image_id
-        image_indices = image_token_mask.nonzero()
+        image_indices = image_token_mask.nonzero().squeeze(-1)
         input_ids, num_image_tokens = self.add_image_token(
             image_indices=image_indices,
             input_ids=input_ids,
@@ -287,6 +482,9 @@ class VLChatProcessor(ProcessorMixin):
             input_ids=input_ids,
             pixel_values=images_outputs.pixel_values,
             num_image_tokens=num_image_tokens,
+            image_keys=(
+                hash_images(images_outputs.pixel_values) if self.dedup_images else None
+            ),
         )
 
         return prepare
@@ -327,56 +525,113 @@ class VLChatProcessor(ProcessorMixin):
         return prepare
 
     def batchify(
-        self, prepare_list: List[VLChatProcessorOutput]
+        self,
+        prepare_list: List[VLChatProcessorOutput],
+        dtype: torch.dtype = torch.float32,
+        pin_memory: bool = False,
+        buffer_pool: Optional[BatchBufferPool] = None,
     ) -> BatchedVLChatProcessorOutput:
         """
         Preprocesses the inputs for multimodal inference.
 
         Args:
             prepare_list (List[VLChatProcessorOutput]): A list of VLChatProcessorOutput.
+            dtype (torch.dtype): the dtype of the batched pixel values, build the batch in the
+                dtype of the model to not cast it after the host-to-device copy.
+            pin_memory (bool): build the batch in pinned memory, `to` then copies it to the GPU
+                asynchronously. Ignored without CUDA.
+            buffer_pool (Optional[BatchBufferPool]): take the batch buffer from this pool, it is
+                returned to the pool once the batch has been moved to the device.
 
         Returns:
             BatchedVLChatProcessorOutput: A dictionary of the inputs to use for multimodal inference.
         """
 
+        pin_memory = pin_memory and torch.cuda.is_available()
+
         batch_size = len(prepare_list)
-        sft_format = []
-        n_images = []
-        seq_lens = []
-        for prepare in prepare_list:
-            n_images.append(len(prepare.num_image_tokens))
-            seq_lens.append(len(prepare))
+        sft_format = [prepare.sft_format for prepare in prepare_list]
+        n_images = [len(prepare.num_image_tokens) for prepare in prepare_list]
+        seq_lens = [len(prepare) for prepare in prepare_list]
 
         input_token_max_len = max(seq_lens)
         max_n_images = max(1, max(n_images))
 
-        batched_input_ids = torch.full(
-            (batch_size, input_token_max_len), self.pad_id
-        ).long()  # FIXME
-        batched_attention_mask = torch.zeros((batch_size, input_token_max_len)).long()
-        batched_pixel_values = torch.zeros(
-            (batch_size, max_n_images, *self.image_processor.default_shape)
-        ).float()
-        batched_images_seq_mask = torch.zeros((batch_size, input_token_max_len)).bool()
-        batched_images_emb_mask = torch.zeros(
-            (batch_size, max_n_images, self.num_image_tokens)
-        ).bool()
+        # all the tensors of the batch are views of one staging buffer
+        layout, nbytes = staging_layout(
+            [
+                (
+                    "pixel_values",
+                    dtype,
+                    (batch_size, max_n_images, *self.image_processor.default_shape),
+                ),
+                ("input_ids", torch.long, (batch_size, input_token_max_len)),
+                ("attention_mask", torch.long, (batch_size, input_token_max_len)),
+                ("images_seq_mask", torch.bool, (batch_size, input_token_max_len)),
+                (
+                    "images_emb_mask",
+                    torch.bool,
+                    (batch_size, max_n_images, self.num_image_tokens),
+                ),
+            ]
+        )
+        if buffer_pool is not None:
+            staging = buffer_pool.acquire(nbytes, pin_memory=pin_memory)
+        else:
+            staging = torch.empty(nbytes, dtype=torch.uint8, pin_memory=pin_memory)
+        views = unpack_staging(staging, layout)
+
+        # left-padding, the last seq_len positions of each row are valid
+        seq_lens = torch.tensor(seq_lens)
+        positions = torch.arange(input_token_max_len)
+        valid = positions[None, :] >= (input_token_max_len - seq_lens)[:, None]
+        batched_attention_mask = views["attention_mask"].copy_(valid)
+
+        # the row-major order of the valid positions is the order of the concatenated ids
+        batched_input_ids = views["input_ids"].fill_(self.pad_id)
+        batched_input_ids.masked_scatter_(
+            valid,
+            torch.cat(
+                [
+                    torch.as_tensor(prepare.input_ids, dtype=torch.long)
+                    for prepare in prepare_list
+                ]
+            ),
+        )
 
+        batched_images_seq_mask = torch.eq(
+            batched_input_ids, self.image_id, out=views["images_seq_mask"]
+        ).logical_and_(valid)
+
+        # [b, n] number of image tokens of each image slot, 0 for the padding slots
+        n_images = torch.tensor(n_images)
+        image_counts = torch.zeros((batch_size, max_n_images), dtype=torch.long)
+        if n_images.sum() > 0:
+            image_rows = torch.repeat_interleave(torch.arange(batch_size), n_images)
+            first_image = torch.repeat_interleave(
+                torch.cumsum(n_images, 0) - n_images, n_images
+            )
+            image_cols = torch.arange(len(image_rows)) - first_image
+            image_counts[image_rows, image_cols] = torch.cat(
+                [prepare.num_image_tokens for prepare in prepare_list]
+            ).long()
+        batched_images_emb_mask = torch.lt(
+            torch.arange(self.num_image_tokens),
+            image_counts[:, :, None],
+            out=views["images_emb_mask"],
+        )
+
+        # the pixels are copied, and cast, in place, only the padding slots are zeroed
+        batched_pixel_values = views["pixel_values"]
         for i, prepare in enumerate(prepare_list):
-            input_ids = prepare.input_ids
-            seq_len = len(prepare)
             n_image = len(prepare.num_image_tokens)
-            # left-padding
-            batched_attention_mask[i, -seq_len:] = 1
-            batched_input_ids[i, -seq_len:] = torch.LongTensor(input_ids)
-            batched_images_seq_mask[i, -seq_len:] = input_ids == self.image_id
-
             if n_image > 0:
-                batched_pixel_values[i, :n_image] = prepare.pixel_values
-                for j, n_image_tokens in enumerate(prepare.num_image_tokens):
-                    batched_images_emb_mask[i, j, :n_image_tokens] = True
+                batched_pixel_values[i, :n_image].copy_(prepare.pixel_values)
+            batched_pixel_values[i, n_image:].zero_()
 
-            sft_format.append(prepare.sft_format)
+        image_keys = None
+        if all(prepare.image_keys is not None for prepare in prepare_list):
+            image_keys = [key for prepare in prepare_list for key in prepare.image_keys]
 
         batched_prepares = BatchedVLChatProcessorOutput(
             input_ids=batched_input_ids,
@@ -385,6 +640,80 @@ class VLChatProcessor(ProcessorMixin):
             images_seq_mask=batched_images_seq_mask,
             images_emb_mask=batched_images_emb_mask,
             sft_format=sft_format,
+            staging=staging,
+            buffer_pool=buffer_pool,
+            image_keys=image_keys,
         )
 
         return batched_prepares
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "deepseek-ai/deepseek-vl-7b-chat"
+    vl_chat_processor = VLChatProcessor.from_pretrained(model_path)
+    image_shape = vl_chat_processor.image_processor.default_shape
+
+    def make_prepare(n_images: int) -> VLChatProcessorOutput:
+        sft_format = "<image_placeholder>" * n_images + "Describe the image."
+        input_ids = torch.LongTensor(vl_chat_processor.tokenizer.encode(sft_format))
+        image_indices = (input_ids == vl_chat_processor.image_id).nonzero().squeeze(-1)
+        input_ids, num_image_tokens = vl_chat_processor.add_image_token(
+            image_indices, input_ids
+        )
+        return VLChatProcessorOutput(
+            sft_format=sft_format,
+            input_ids=input_ids,
+            pixel_values=torch.rand(n_images, *image_shape),
+            num_image_tokens=num_image_tokens,
+        )
+
+    # add_image_token with slices and torch.cat vs a single repeat_interleave
+    def add_image_token_concat(image_indices, input_ids):
+        input_slices, start = [], 0
+        for index in image_indices:
+            end = index + 1 if vl_chat_processor.add_special_token else index
+            input_slices.append(input_ids[start:end])
+            input_slices.append(
+                vl_chat_processor.image_id
+                * torch.ones((vl_chat_processor.num_image_tokens,), dtype=torch.long)
+            )
+            start = index + 1
+        input_slices.append(input_ids[start:])
+        return torch.cat(input_slices, dim=0)
+
+    for n_images in [1, 4, 16]:
+        sft_format = "Compare these images. <image_placeholder>" * n_images
+        input_ids = torch.LongTensor(vl_chat_processor.tokenizer.encode(sft_format))
+        image_indices = (input_ids == vl_chat_processor.image_id).nonzero().squeeze(-1)
+
+        expected = add_image_token_concat(image_indices, input_ids)
+        output, _ = vl_chat_processor.add_image_token(image_indices, input_ids)
+        assert torch.equal(output, expected)
+
+        for name, fn in [
+            ("concat", add_image_token_concat),
+            ("repeat_interleave", vl_chat_processor.add_image_token),
+        ]:
+            start = time.perf_counter()
+            for _ in range(1000):
+                fn(image_indices, input_ids)
+            elapsed = (time.perf_counter() - start) / 1000 * 1e6
+            print(f"add_image_token, {n_images} images, {name}: {elapsed:.1f} us")
+
+    # batchify with fresh buffers vs a buffer pool, in steady state
+    prepare_list = [make_prepare(n_images) for n_images in [1, 1, 2, 1, 0, 1, 1, 1]]
+    buffer_pool = BatchBufferPool()
+    for name, pool in [("fresh buffers", None), ("buffer pool", buffer_pool)]:
+        for step in range(6):
+            if step == 1:
+                start = time.perf_counter()
+            batch = vl_chat_processor.batchify(
+                prepare_list, dtype=torch.bfloat16, buffer_pool=pool
+            )
+            batch.release()
+        elapsed = (time.perf_counter() - start) / 5 * 1000
+        print(f"batchify, {name}: {elapsed:.1f} ms/batch")
+    print(buffer_pool.stats())
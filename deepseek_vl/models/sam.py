@@ -6,7 +6,7 @@
 
 import copy
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache, partial
 from typing import List, Optional, Tuple, Type, Union
 
 import torch
@@ -68,6 +68,7 @@ class ImageEncoderViT(nn.Module):
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
         downsample_channels: Tuple[int, ...] = (512, 1024),
+        use_sdpa: bool = True,
     ) -> None:
         """
         Args:
@@ -87,6 +88,7 @@ class ImageEncoderViT(nn.Module):
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
             downsample_channels (list): Channels for downsampling layers.
+            use_sdpa (bool): If True, use fused scaled_dot_product_attention in the attention blocks.
         """
         super().__init__()
         self.img_size = img_size
@@ -120,6 +122,7 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                use_sdpa=use_sdpa,
             )
             self.blocks.append(block)
 
@@ -165,6 +168,11 @@ class ImageEncoderViT(nn.Module):
             self.neck_hd = copy.deepcopy(self.neck)
             # self.downsamples_hd = copy.deepcopy(self.downsamples)
 
+    def set_use_sdpa(self, use_sdpa: bool):
+        """Switch all attention blocks between fused SDPA and the explicit attention map."""
+        for blk in self.blocks:
+            blk.attn.use_sdpa = use_sdpa
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
@@ -213,6 +221,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        use_sdpa: bool = True,
     ) -> None:
         """
         Args:
@@ -228,6 +237,7 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            use_sdpa (bool): If True, use fused scaled_dot_product_attention.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -238,6 +248,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            use_sdpa=use_sdpa,
         )
 
         self.norm2 = norm_layer(dim)
@@ -277,6 +288,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        use_sdpa: bool = True,
     ) -> None:
         """
         Args:
@@ -287,11 +299,17 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            use_sdpa (bool): If True, use fused scaled_dot_product_attention with the relative
+                positions as additive attention bias, instead of the explicit attention map.
+                The bias is a dense float [B, nHead, H * W, H * W] mask: only the math
+                and memory-efficient SDPA backends take it, not the flash kernel, and
+                the bias alone is as large as the attention map.
         """
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
+        self.use_sdpa = use_sdpa
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.proj = nn.Linear(dim, dim)
@@ -305,6 +323,65 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # (q_size, k_size, device, dtype, inference mode) -> (Rh, Rw), valid for _rel_pos_version
+        self._rel_pos_tables = {}
+        self._rel_pos_version = None
+
+    def get_rel_pos_tables(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get the relative positional tables Rh and Rw for the given query and key sizes.
+
+        The tables only depend on the relative positional parameters, so they are built once per
+        (q_size, k_size, device, dtype) and reused until the parameters are modified in-place,
+        reloaded or moved. When gradients flow into the parameters, the tables are rebuilt.
+
+        Args:
+            q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+            k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+        Returns:
+            Rh (Tensor): height table with shape (q_h, k_h, C).
+            Rw (Tensor): width table with shape (q_w, k_w, C).
+        """
+        rel_pos_h, rel_pos_w = self.rel_pos_h, self.rel_pos_w
+        if torch.is_grad_enabled() and (
+            rel_pos_h.requires_grad or rel_pos_w.requires_grad
+        ):
+            return (
+                get_rel_pos(q_size[0], k_size[0], rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], rel_pos_w),
+            )
+
+        version = (
+            rel_pos_h._version,
+            rel_pos_h.data_ptr(),
+            rel_pos_w._version,
+            rel_pos_w.data_ptr(),
+        )
+        if version != self._rel_pos_version:
+            self._rel_pos_tables = {}
+            self._rel_pos_version = version
+
+        key = (
+            q_size,
+            k_size,
+            rel_pos_h.device,
+            rel_pos_h.dtype,
+            torch.is_inference_mode_enabled(),
+        )
+        tables = self._rel_pos_tables.get(key)
+        if tables is None:
+            with torch.no_grad():
+                tables = (
+                    get_rel_pos(q_size[0], k_size[0], rel_pos_h),
+                    get_rel_pos(q_size[1], k_size[1], rel_pos_w),
+                )
+            self._rel_pos_tables[key] = tables
+
+        return tables
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -317,9 +394,13 @@ class Attention(nn.Module):
         def do_attention(q, k, v):
             attn = (q * self.scale) @ k.transpose(-2, -1)
             if self.use_rel_pos:
-                attn = add_decomposed_rel_pos(
-                    attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W)
-                )
+                Rh, Rw = self.get_rel_pos_tables((H, W), (H, W))
+                rel_h, rel_w = get_decomposed_rel_pos(q, Rh, Rw, (H, W))
+                attn = (
+                    attn.view(B * self.num_heads, H, W, H, W)
+                    + rel_h[:, :, :, :, None]
+                    + rel_w[:, :, :, None, :]
+                ).view(B * self.num_heads, H * W, H * W)
 
             attn = attn.softmax(dim=-1)
             x = (
@@ -331,9 +412,35 @@ class Attention(nn.Module):
 
             return x
 
+        def do_sdpa_attention(q, k, v):
+            attn_bias = None
+            if self.use_rel_pos:
+                Rh, Rw = self.get_rel_pos_tables((H, W), (H, W))
+                rel_h, rel_w = get_decomposed_rel_pos(q, Rh, Rw, (H, W))
+                attn_bias = (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(
+                    B, self.num_heads, H * W, H * W
+                )
+
+            x = F.scaled_dot_product_attention(
+                q.view(B, self.num_heads, H * W, -1),
+                k.view(B, self.num_heads, H * W, -1),
+                v.view(B, self.num_heads, H * W, -1),
+                attn_mask=attn_bias,
+            )
+            x = (
+                x.view(B, self.num_heads, H, W, -1)
+                .permute(0, 2, 3, 1, 4)
+                .reshape(B, H, W, -1)
+            )
+
+            return x
+
         # from haiscale.utils import on_demand_checkpoint
         # x = on_demand_checkpoint(do_attention, q, k, v)
-        x = do_attention(q, k, v)
+        if self.use_sdpa:
+            x = do_sdpa_attention(q, k, v)
+        else:
+            x = do_attention(q, k, v)
         x = self.proj(x)
 
         return x
@@ -422,12 +529,51 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     else:
         rel_pos_resized = rel_pos
 
+    relative_coords = get_relative_coords(q_size, k_size, rel_pos.device)
+
+    return rel_pos_resized[relative_coords]
+
+
+@lru_cache(maxsize=None)
+def get_relative_coords(q_size: int, k_size: int, device: torch.device) -> torch.Tensor:
+    """
+    Get the (q_size, k_size) index of each query/key pair into the relative positional embeddings.
+    The result only depends on the sizes, so it is cached per (q_size, k_size, device).
+    """
     # Scale the coords with short length if shapes for q and k are different.
     q_coords = torch.arange(q_size)[:, None] * max(k_size / q_size, 1.0)
     k_coords = torch.arange(k_size)[None, :] * max(q_size / k_size, 1.0)
     relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
 
-    return rel_pos_resized[relative_coords.long()]
+    return relative_coords.long().to(device)
+
+
+def get_decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the height and width terms of the decomposed Relative Positional Embeddings.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): relative position table (q_h, k_h, C) for height axis, from get_rel_pos.
+        Rw (Tensor): relative position table (q_w, k_w, C) for width axis, from get_rel_pos.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+
+    Returns:
+        rel_h (Tensor): height term with shape (B, q_h, q_w, k_h).
+        rel_w (Tensor): width term with shape (B, q_h, q_w, k_w).
+    """
+    q_h, q_w = q_size
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+
+    return rel_h, rel_w
 
 
 def add_decomposed_rel_pos(
@@ -456,12 +602,9 @@ def add_decomposed_rel_pos(
     k_h, k_w = k_size
     Rh = get_rel_pos(q_h, k_h, rel_pos_h)
     Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+    rel_h, rel_w = get_decomposed_rel_pos(q, Rh, Rw, q_size)
 
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
-
+    B = q.shape[0]
     attn = (
         attn.view(B, q_h, q_w, k_h, k_w)
         + rel_h[:, :, :, :, None]
@@ -575,6 +718,7 @@ def create_sam_vit(
         window_size=14,
         out_chans=sam_cfg.prompt_embed_dim,
         downsample_channels=sam_cfg.downsample_channels,
+        use_sdpa=kwargs.get("use_sdpa", True),
     )
 
     if ckpt_path:
@@ -586,6 +730,96 @@ def create_sam_vit(
 
 
 if __name__ == "__main__":
+    import multiprocessing
+    import resource
+    import time
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def run_block(block, x, use_sdpa):
+        """Latency of the block, and the peak memory its forward adds."""
+        block.attn.use_sdpa = use_sdpa
+        # ru_maxrss is in KiB, and only grows: it is read before the warm-up forward
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with torch.no_grad():
+            block(x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            for _ in range(5):
+                block(x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+                peak = f"{torch.cuda.max_memory_allocated() / 2**20:.1f} MiB"
+            else:
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                peak = f"{(rss - start_rss) / 2**10:.1f} MiB over the RSS before"
+        elapsed = (time.perf_counter() - start) / 5 * 1000
+        return f"{elapsed:.2f} ms/block, peak memory {peak}"
+
+    def measure(block, x, use_sdpa):
+        if device == "cuda":
+            return run_block(block, x, use_sdpa)
+
+        # the peak RSS of the process never goes down: measure each path in a fork of
+        # this process, which has not run a global attention block yet
+        def child(conn):
+            conn.send(run_block(block, x, use_sdpa))
+
+        context = multiprocessing.get_context("fork")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=child, args=(child_conn,))
+        process.start()
+        result = parent_conn.recv()
+        process.join()
+        return result
+
+    torch.manual_seed(0)
+    for window_size, input_size in [(14, (14, 14)), (0, (64, 64))]:
+        block = Block(
+            dim=768,
+            num_heads=12,
+            qkv_bias=True,
+            use_rel_pos=True,
+            rel_pos_zero_init=False,
+            window_size=window_size,
+            input_size=input_size,
+        ).eval()
+        nn.init.normal_(block.attn.rel_pos_h, std=0.02)
+        nn.init.normal_(block.attn.rel_pos_w, std=0.02)
+        x = torch.randn(1, 64, 64, 768)
+
+        # per-block latency and peak memory, before this process runs the block
+        dtype = torch.bfloat16 if device == "cuda" else torch.float32
+        block, x = block.to(device=device, dtype=dtype), x.to(device, dtype)
+        for use_sdpa in (False, True):
+            print(
+                f"window_size={window_size}, use_sdpa={use_sdpa}: "
+                + measure(block, x, use_sdpa)
+            )
+
+        # numerical equivalence of the fused and explicit attention paths
+        block, x = block.float().cpu(), x.float().cpu()
+        with torch.no_grad():
+            block.attn.use_sdpa = False
+            ref = block(x)
+            block.attn.use_sdpa = True
+            out = block(x)
+        print(
+            f"window_size={window_size}: max abs diff = {(out - ref).abs().max().item():.3e}"
+        )
+        assert torch.allclose(out, ref, atol=1e-4, rtol=1e-4)
+
+    # the cached relative positional tables follow in-place weight updates
+    attn = Attention(dim=768, num_heads=12, use_rel_pos=True, input_size=(14, 14))
+    with torch.no_grad():
+        Rh, _ = attn.get_rel_pos_tables((14, 14), (14, 14))
+        assert attn.get_rel_pos_tables((14, 14), (14, 14))[0] is Rh
+        attn.rel_pos_h.normal_()
+        Rh, _ = attn.get_rel_pos_tables((14, 14), (14, 14))
+        assert torch.equal(Rh, get_rel_pos(14, 14, attn.rel_pos_h))
+
     x = torch.zeros(2, 3, 1024, 1024).bfloat16()
     # x.permute(0, 3, 1, 2)
     net = create_sam_vit().bfloat16()
@@ -41,6 +41,7 @@ from deepseek_vl.serve.inference import (
     deepseek_generate,
     load_model,
 )
+from deepseek_vl.serve.speculative import PhraseTrie
 from deepseek_vl.utils.conversation import SeparatorStyle
 
 
@@ -58,6 +59,8 @@ def load_models():
 logger = configure_logger()
 models = load_models()
 MODELS = sorted(list(models.keys()))
+# the n-grams of the recent responses of every model, to decode the greedy ones faster
+phrase_tries = {model_name: PhraseTrie() for model_name in models}
 
 
 def generate_prompt_with_history(
@@ -258,6 +261,7 @@ def predict(
             temperature=temperature,
             repetition_penalty=repetition_penalty,
             top_p=top_p,
+            phrase_trie=phrase_tries[model_select_dropdown],
         ):
             full_response += x
             response = strip_stop_words(full_response, stop_words)
@@ -0,0 +1,211 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL.Image import Image
+
+
+class CaptionCache(object):
+    """
+    Content-addressed cache of generated captions.
+
+    Entries live in a bounded in-memory LRU tier, and optionally in a sqlite file
+    that survives restarts. Both tiers expire entries after `ttl` seconds when set.
+    The sqlite file keeps at most `max_disk_entries` rows, the oldest written are
+    evicted first, and its expired rows are swept every `sweep_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = None,
+        disk_path: Optional[str] = None,
+        max_disk_entries: int = 65536,
+        sweep_interval: float = 60.0,
+    ):
+        """
+        Args:
+            max_entries (int): capacity of the in-memory tier.
+            ttl (float, optional): seconds after which an entry expires. Defaults to never.
+            disk_path (str, optional): path of the sqlite file of the on-disk tier.
+                Defaults to no on-disk tier.
+            max_disk_entries (int): capacity of the on-disk tier, 0 for no limit.
+            sweep_interval (float): seconds between two deletions of the expired rows
+                of the on-disk tier, done by `put`.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.sweep_interval = sweep_interval
+
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = dict(
+            hits=0, disk_hits=0, misses=0, evictions=0, disk_evictions=0, expirations=0
+        )
+
+        self._db = None
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS captions "
+                "(key TEXT PRIMARY KEY, caption TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS captions_expires_at ON captions (expires_at)"
+            )
+            self._db.commit()
+            self._disk_entries = self._db.execute(
+                "SELECT COUNT(*) FROM captions"
+            ).fetchone()[0]
+            self._last_sweep = time.time()
+
+    @staticmethod
+    def make_key(
+        image: Image, prompt: str, max_new_tokens: int, checkpoint: str
+    ) -> str:
+        """
+
+        Args:
+            image (PIL.Image): the decoded image, hashed by its pixels.
+            prompt (str): the caption prompt.
+            max_new_tokens (int): the generation budget.
+            checkpoint (str): the model checkpoint that generates the caption.
+
+        Returns:
+            key (str): the hex digest identifying the caption.
+        """
+
+        h = hashlib.blake2b(digest_size=32)
+        for part in (
+            checkpoint,
+            prompt,
+            str(max_new_tokens),
+            image.mode,
+            str(image.size),
+        ):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                caption, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return caption
+
+                del self._entries[key]
+                self._counters["expirations"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT caption, expires_at FROM captions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    caption, expires_at = row
+                    if expires_at > now:
+                        self._insert(key, caption, expires_at)
+                        self._counters["hits"] += 1
+                        self._counters["disk_hits"] += 1
+                        return caption
+
+                    self._db.execute("DELETE FROM captions WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._disk_entries -= 1
+                    self._counters["expirations"] += 1
+
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key: str, caption: str):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            self._insert(key, caption, expires_at)
+            if self._db is not None:
+                self._insert_row(key, caption, expires_at, now)
+
+    def _insert_row(self, key: str, caption: str, expires_at: float, now: float):
+        exists = self._db.execute(
+            "SELECT 1 FROM captions WHERE key = ?", (key,)
+        ).fetchone()
+        # a replaced row gets a new rowid, the rowids follow the order of the writes
+        self._db.execute(
+            "INSERT OR REPLACE INTO captions VALUES (?, ?, ?)",
+            (key, caption, expires_at),
+        )
+        if exists is None:
+            self._disk_entries += 1
+
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            n_expired = self._db.execute(
+                "DELETE FROM captions WHERE expires_at <= ?", (now,)
+            ).rowcount
+            self._disk_entries -= n_expired
+            self._counters["expirations"] += n_expired
+
+        if self.max_disk_entries > 0 and self._disk_entries > self.max_disk_entries:
+            n_evicted = self._db.execute(
+                "DELETE FROM captions WHERE rowid IN "
+                "(SELECT rowid FROM captions ORDER BY rowid LIMIT ?)",
+                (self._disk_entries - self.max_disk_entries,),
+            ).rowcount
+            self._disk_entries -= n_evicted
+            self._counters["disk_evictions"] += n_evicted
+        self._db.commit()
+
+    def _insert(self, key: str, caption: str, expires_at: float):
+        self._entries[key] = (caption, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM captions")
+                self._db.commit()
+                self._disk_entries = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            if self._db is not None:
+                stats["disk_entries"] = self._disk_entries
+        return stats
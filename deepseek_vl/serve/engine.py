@@ -0,0 +1,715 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import torch
+from transformers import DynamicCache, LlamaForCausalLM, TextIteratorStreamer
+
+from deepseek_vl.serve.kv_cache import PagedKVCache
+
+_STOP = object()
+
+
+class GenerationRequest(object):
+    """One sequence of the engine, from its submission to its retirement."""
+
+    def __init__(
+        self,
+        inputs: Any,
+        max_new_tokens: int,
+        streamer: Optional[TextIteratorStreamer] = None,
+        cancel_event: Optional[threading.Event] = None,
+        prefix_ids: Sequence[int] = (),
+    ):
+        self.inputs = inputs
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.cancel_event = cancel_event
+        self.prefix_ids = prefix_ids
+
+        # [T, D], from the admission to the prefill
+        self.prompt_embeds: Optional[torch.Tensor] = None
+        # the sequence in the paged KV cache, and its prompt tokens already in cache
+        self.seq_id: Optional[int] = None
+        self.n_cached = 0
+        self.output_ids: List[int] = []
+        self.finished = False
+        self.future = Future()
+
+    @property
+    def done(self) -> bool:
+        return self.finished or (
+            self.cancel_event is not None and self.cancel_event.is_set()
+        )
+
+
+class _PaddedKVBatch(object):
+    """
+    The KV cache of the running sequences, one row per sequence, left-padded to the
+    longest one. Rows join with `concat` and leave with `select`, the decode steps in
+    between only append.
+    """
+
+    def __init__(
+        self,
+        past_key_values: DynamicCache,
+        attention_mask: torch.LongTensor,
+        positions: torch.LongTensor,
+    ):
+        """
+        Args:
+            past_key_values (DynamicCache): [b, h, L, d] per layer.
+            attention_mask (torch.LongTensor): [b, L], 0 on the padding.
+            positions (torch.LongTensor): [b], the position of the next token of each row.
+        """
+
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.positions = positions
+
+    def __len__(self) -> int:
+        return self.attention_mask.shape[0]
+
+    def concat(self, other: "_PaddedKVBatch") -> "_PaddedKVBatch":
+        length = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+        left, right = self._pad(length), other._pad(length)
+        return _PaddedKVBatch(
+            DynamicCache.from_legacy_cache(
+                tuple(
+                    (torch.cat([k1, k2]), torch.cat([v1, v2]))
+                    for (k1, v1), (k2, v2) in zip(left[0], right[0])
+                )
+            ),
+            torch.cat([left[1], right[1]]),
+            torch.cat([self.positions, other.positions]),
+        )
+
+    def _pad(self, length: int):
+        n_padding = length - self.attention_mask.shape[1]
+        past_key_values = self.past_key_values.to_legacy_cache()
+        if n_padding == 0:
+            return past_key_values, self.attention_mask
+
+        def pad(t: torch.Tensor) -> torch.Tensor:
+            return torch.cat(
+                [t.new_zeros(*t.shape[:2], n_padding, t.shape[3]), t], dim=2
+            )
+
+        attention_mask = torch.cat(
+            [self.attention_mask.new_zeros(len(self), n_padding), self.attention_mask],
+            dim=1,
+        )
+        return tuple((pad(k), pad(v)) for k, v in past_key_values), attention_mask
+
+    def select(self, rows: List[int]) -> "_PaddedKVBatch":
+        index = torch.tensor(rows, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[index]
+
+        # drop the columns that are padding in all the remaining rows
+        start = int(attention_mask.any(dim=0).int().argmax())
+        attention_mask = attention_mask[:, start:]
+        return _PaddedKVBatch(
+            DynamicCache.from_legacy_cache(
+                tuple(
+                    (k[index, :, start:], v[index, :, start:])
+                    for k, v in self.past_key_values.to_legacy_cache()
+                )
+            ),
+            attention_mask,
+            self.positions[index],
+        )
+
+    def step_inputs(self) -> Dict[str, Any]:
+        """The cache inputs of the next decode step, one new token per row."""
+
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(len(self), 1)], dim=1
+        )
+        position_ids = self.positions[:, None]
+        self.positions = self.positions + 1
+        return dict(
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past_key_values,
+        )
+
+    def release(self):
+        pass
+
+
+class _PagedKVBatch(object):
+    """
+    The running sequences of a `PagedKVCache`, in the order of the rows of the engine.
+    The rows that leave with `select` free their blocks.
+    """
+
+    def __init__(self, kv_cache: PagedKVCache, seq_ids: List[int]):
+        self.kv_cache = kv_cache
+        self.seq_ids = seq_ids
+
+    def __len__(self) -> int:
+        return len(self.seq_ids)
+
+    def concat(self, other: "_PagedKVBatch") -> "_PagedKVBatch":
+        return _PagedKVBatch(self.kv_cache, self.seq_ids + other.seq_ids)
+
+    def select(self, rows: List[int]) -> "_PagedKVBatch":
+        keep = set(rows)
+        for i, seq_id in enumerate(self.seq_ids):
+            if i not in keep:
+                self.kv_cache.free(seq_id)
+        return _PagedKVBatch(self.kv_cache, [self.seq_ids[i] for i in rows])
+
+    def step_inputs(self) -> Dict[str, Any]:
+        """The cache inputs of the next decode step, one new token per row."""
+
+        past_key_values, attention_mask = self.kv_cache.step(self.seq_ids)
+        return dict(
+            attention_mask=attention_mask,
+            position_ids=attention_mask.sum(dim=1, keepdim=True) - 1,
+            past_key_values=past_key_values,
+        )
+
+    def release(self):
+        for seq_id in self.seq_ids:
+            self.kv_cache.free(seq_id)
+        self.seq_ids = []
+
+
+class ContinuousBatchingEngine(object):
+    """
+    Greedy generation over a changing set of sequences, scheduled one token at a time.
+
+    Every step admits waiting requests, at most `max_prefill_size` of them and up to
+    `max_running` sequences in total, and prefills them together. It then runs one
+    decode step over all the running sequences. A sequence retires as soon as it emits
+    EOS, reaches its own `max_new_tokens` or its `cancel_event` is set: its future
+    resolves with its generated ids (EOS included) and its row leaves the batch. Short
+    captions do not wait for the long ones, and new requests do not wait for the
+    running ones to finish.
+
+    `embed` turns the `inputs` of the admitted requests into their prompt embeddings,
+    [T_i, D] each, on the engine thread. By default the inputs are the embeddings.
+
+    The KV cache of the running sequences is a left-padded batch by default. With a
+    `PagedKVCache` it is block-allocated instead: requests are only admitted while their
+    blocks fit, and the prompts that start with the same `prefix_ids` share the blocks
+    of this prefix and do not prefill it again. Its decode steps are no faster, the
+    blocks are gathered back into a padded tensor at every step.
+    """
+
+    def __init__(
+        self,
+        language_model: LlamaForCausalLM,
+        eos_token_id: int,
+        embed: Optional[Callable[[List[Any]], List[torch.Tensor]]] = None,
+        max_running: int = 32,
+        max_prefill_size: int = 8,
+        kv_cache: Optional[PagedKVCache] = None,
+        name: str = "generation-engine",
+    ):
+        assert max_running > 0, "max_running should be positive."
+        assert max_prefill_size > 0, "max_prefill_size should be positive."
+
+        self.language_model = language_model
+        self.eos_token_id = eos_token_id
+        self.embed = embed if embed is not None else list
+        self.max_running = max_running
+        self.max_prefill_size = max_prefill_size
+        self.kv_cache = kv_cache
+        self.name = name
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._waiting: List[GenerationRequest] = []
+        self._running: List[GenerationRequest] = []
+        self._batch: Optional[Union[_PaddedKVBatch, _PagedKVBatch]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._counters = dict(
+            steps=0,
+            prefills=0,
+            prefill_tokens=0,
+            generated_tokens=0,
+            completed=0,
+            failed=0,
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+        # fail the sequences that were running and whatever was submitted after the
+        # stop request
+        self._poll(block=False)
+        for request in self._running:
+            self._finish(request, RuntimeError(f"{self.name} is stopped."))
+        for request in self._waiting:
+            if self._start(request):
+                self._finish(request, RuntimeError(f"{self.name} is stopped."))
+        if self._batch is not None:
+            self._batch.release()
+        self._running, self._waiting, self._batch = [], [], None
+
+    def submit(
+        self,
+        inputs: Any,
+        max_new_tokens: int,
+        streamer: Optional[TextIteratorStreamer] = None,
+        cancel_event: Optional[threading.Event] = None,
+        prefix_ids: Sequence[int] = (),
+    ) -> Future:
+        """
+
+        Args:
+            inputs (Any): the prompt, as accepted by `embed`.
+            max_new_tokens (int): the generation budget of this sequence.
+            streamer (TextIteratorStreamer, optional): receives the tokens as they are
+                generated, like with `generate`.
+            cancel_event (threading.Event, optional): retires the sequence once set.
+            prefix_ids (Sequence[int]): the token ids the prompt starts with, before its
+                first image. Only used with a paged KV cache, to share the prefix blocks.
+
+        Returns:
+            future (concurrent.futures.Future): resolved with the generated token ids.
+                Cancelling it before the sequence is admitted drops the request.
+        """
+
+        request = GenerationRequest(
+            inputs, max_new_tokens, streamer, cancel_event, prefix_ids
+        )
+        self._queue.put(request)
+        return request.future
+
+    def run_until_idle(self):
+        """Runs the steps on the calling thread until every submitted sequence is done."""
+
+        assert self._thread is None, f"{self.name} is running on its own thread."
+        self._poll(block=False)
+        while len(self._running) > 0 or len(self._waiting) > 0:
+            self.step()
+            self._poll(block=False)
+
+    def _poll(self, block: bool) -> bool:
+        """Moves the submitted requests to the waiting list, False once stopped."""
+
+        while True:
+            try:
+                request = self._queue.get(block=block)
+            except queue.Empty:
+                return True
+            if request is _STOP:
+                return False
+            self._waiting.append(request)
+            block = False
+
+    def _run(self):
+        while self._poll(block=len(self._running) == 0 and len(self._waiting) == 0):
+            self.step()
+
+    @torch.inference_mode()
+    def step(self):
+        """Admits and prefills the waiting requests, then decodes one token per sequence."""
+
+        admitted = self._admit()
+        if len(admitted) > 0:
+            self._prefill(admitted)
+            self._retire()
+
+        if len(self._running) > 0:
+            try:
+                self._decode()
+            except Exception as e:
+                for request in self._running:
+                    self._finish(request, e)
+                self._batch.release()
+                self._running, self._batch = [], None
+            self._retire()
+
+        with self._lock:
+            self._counters["steps"] += 1
+
+    def _admit(self) -> List[GenerationRequest]:
+        admitted = []
+        while (
+            len(self._waiting) > 0
+            and len(admitted) < self.max_prefill_size
+            and len(self._running) + len(admitted) < self.max_running
+        ):
+            request = self._waiting.pop(0)
+            # the caller gave up before the request started
+            if self._start(request):
+                admitted.append(request)
+        return admitted
+
+    @staticmethod
+    def _start(request: GenerationRequest) -> bool:
+        # requests put back to wait for KV cache blocks have started already
+        return request.future.running() or request.future.set_running_or_notify_cancel()
+
+    def _prefill(self, admitted: List[GenerationRequest]):
+        embedded = [
+            request for request in admitted if request.prompt_embeds is not None
+        ]
+        try:
+            new = [request for request in admitted if request.prompt_embeds is None]
+            if len(new) > 0:
+                prompts_embeds = self.embed([request.inputs for request in new])
+                for request, embeds in zip(new, prompts_embeds):
+                    request.prompt_embeds = embeds
+                embedded.extend(new)
+        except Exception as e:
+            for request in new:
+                self._finish(request, e)
+        admitted = [request for request in admitted if request in embedded]
+
+        if self.kv_cache is not None:
+            admitted = self._allocate(admitted)
+        if len(admitted) == 0:
+            return
+
+        try:
+            batch, logits, n_computed = self._forward_prefill(admitted)
+        except Exception as e:
+            for request in admitted:
+                if request.seq_id is not None:
+                    self.kv_cache.free(request.seq_id)
+                self._finish(request, e)
+            return
+
+        for request in admitted:
+            request.prompt_embeds = None
+            if request.streamer is not None:
+                # `generate` sends the prompt first, a streamer may skip it
+                request.streamer.put(torch.empty(0, dtype=torch.long))
+
+        self._batch = batch if self._batch is None else self._batch.concat(batch)
+        self._running.extend(admitted)
+        self._append(admitted, logits.argmax(dim=-1))
+
+        with self._lock:
+            self._counters["prefills"] += 1
+            self._counters["prefill_tokens"] += n_computed
+
+    def _allocate(self, admitted: List[GenerationRequest]) -> List[GenerationRequest]:
+        """
+        Starts the sequences in the paged KV cache. The requests whose blocks do not
+        fit go back to the front of the waiting list, until running sequences finish.
+        """
+
+        started = []
+        for i, request in enumerate(admitted):
+            try:
+                allocation = self.kv_cache.allocate(
+                    len(request.prompt_embeds),
+                    request.max_new_tokens,
+                    request.prefix_ids,
+                )
+            except ValueError as e:
+                self._finish(request, e)
+                continue
+
+            if allocation is None:
+                self._waiting[:0] = admitted[i:]
+                break
+            request.seq_id, request.n_cached = allocation
+            started.append(request)
+        return started
+
+    def _forward_prefill(self, admitted: List[GenerationRequest]):
+        """
+        Runs the prompts through the language model as one left-padded batch.
+
+        Returns:
+            batch (Union[_PaddedKVBatch, _PagedKVBatch]): the KV cache of the prompts.
+            logits (torch.Tensor): [b, V], the logits of the first new tokens.
+            n_computed (int): the number of prompt tokens that went through the model.
+        """
+
+        # with the paged cache, the prefix all the prompts have in cache is not computed
+        n_past = 0
+        if self.kv_cache is not None:
+            n_past = min(request.n_cached for request in admitted)
+        prompts_embeds = [request.prompt_embeds[n_past:] for request in admitted]
+
+        lengths = [len(embeds) for embeds in prompts_embeds]
+        seq_len = max(lengths)
+        inputs_embeds = prompts_embeds[0].new_zeros(
+            len(admitted), seq_len, prompts_embeds[0].shape[-1]
+        )
+        attention_mask = torch.zeros(
+            len(admitted),
+            n_past + seq_len,
+            dtype=torch.long,
+            device=inputs_embeds.device,
+        )
+        attention_mask[:, :n_past] = 1
+        for i, embeds in enumerate(prompts_embeds):
+            inputs_embeds[i, seq_len - len(embeds) :] = embeds
+            attention_mask[i, n_past + seq_len - len(embeds) :] = 1
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        past_key_values = None
+        if n_past > 0:
+            past_key_values = self.kv_cache.gather(
+                [request.seq_id for request in admitted], n_past
+            )
+        outputs = self.language_model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, n_past:],
+            past_key_values=DynamicCache.from_legacy_cache(past_key_values),
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        logits = outputs.logits[:, -1]
+
+        if self.kv_cache is None:
+            batch = _PaddedKVBatch(
+                outputs.past_key_values,
+                attention_mask,
+                torch.tensor(lengths, device=attention_mask.device),
+            )
+            return batch, logits, sum(lengths)
+
+        # move the prompts into their blocks, the rows are right-aligned
+        past_key_values = outputs.past_key_values.to_legacy_cache()
+        for i, (request, length) in enumerate(zip(admitted, lengths)):
+            self.kv_cache.store(
+                request.seq_id,
+                n_past,
+                tuple(
+                    (k[i, :, -length:], v[i, :, -length:]) for k, v in past_key_values
+                ),
+            )
+        batch = _PagedKVBatch(self.kv_cache, [request.seq_id for request in admitted])
+        return batch, logits, sum(lengths)
+
+    def _decode(self):
+        input_ids = torch.tensor(
+            [[request.output_ids[-1]] for request in self._running],
+            device=self.language_model.device,
+        )
+        outputs = self.language_model(
+            input_ids=input_ids, use_cache=True, **self._batch.step_inputs()
+        )
+        self._append(self._running, outputs.logits[:, -1].argmax(dim=-1))
+
+    def _append(self, requests: List[GenerationRequest], next_tokens: torch.LongTensor):
+        for request, token_id in zip(requests, next_tokens.tolist()):
+            request.output_ids.append(token_id)
+            if request.streamer is not None:
+                request.streamer.put(torch.tensor([token_id]))
+            if (
+                token_id == self.eos_token_id
+                or len(request.output_ids) >= request.max_new_tokens
+            ):
+                request.finished = True
+
+        with self._lock:
+            self._counters["generated_tokens"] += len(requests)
+
+    def _retire(self):
+        keep = [i for i, request in enumerate(self._running) if not request.done]
+        if len(keep) == len(self._running):
+            return
+
+        for request in self._running:
+            if request.done:
+                self._finish(request)
+        self._running = [self._running[i] for i in keep]
+        if len(keep) > 0:
+            self._batch = self._batch.select(keep)
+        else:
+            self._batch.release()
+            self._batch = None
+
+    def _finish(
+        self, request: GenerationRequest, exception: Optional[Exception] = None
+    ):
+        if request.streamer is not None:
+            request.streamer.end()
+        if exception is not None:
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(request.output_ids)
+
+        with self._lock:
+            self._counters["failed" if exception is not None else "completed"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(running=len(self._running), waiting=len(self._waiting))
+        if self.kv_cache is not None:
+            stats["kv_cache"] = self.kv_cache.stats()
+        return stats
+
+
+if __name__ == "__main__":
+    import time
+
+    from deepseek_vl.models import MultiModalityCausalLM
+    from deepseek_vl.models.modeling_vlm import MultiModalityConfig
+
+    # a tiny random-weight model, the engine only drives its language model
+    torch.manual_seed(0)
+    config = MultiModalityConfig(
+        vision_config=dict(
+            cls="CLIPVisionTower",
+            params=dict(
+                model_name="siglip_large_patch16_384",
+                image_size=32,
+                select_feature="same",
+                select_layer=1,
+            ),
+        ),
+        aligner_config=dict(
+            cls="MlpProjector",
+            params=dict(
+                projector_type="mlp_gelu", input_dim=1024, n_embed=256, depth=2
+            ),
+        ),
+        language_config=dict(
+            vocab_size=1024,
+            hidden_size=256,
+            intermediate_size=512,
+            num_hidden_layers=4,
+            num_attention_heads=4,
+            max_position_embeddings=1024,
+        ),
+    )
+    language_model = MultiModalityCausalLM(config).language_model.eval()
+    eos_token_id = 2
+
+    # captions of 10 to 120 tokens, after a prompt of ~600 image and text tokens
+    n_requests, batch_size = 32, 8
+    max_new_tokens = torch.randint(10, 121, (n_requests,)).tolist()
+    # the same system prompt, then image embeddings
+    prefix_ids = torch.randint(3, 1024, (48,)).tolist()
+    with torch.inference_mode():
+        prefix_embeds = language_model.get_input_embeddings()(torch.tensor(prefix_ids))
+    prompts = [
+        torch.cat(
+            [
+                prefix_embeds,
+                torch.randn(int(length), config.language_config.hidden_size) * 0.02,
+            ]
+        )
+        for length in torch.randint(530, 570, (n_requests,))
+    ]
+
+    @torch.inference_mode()
+    def generate(
+        prompts_embeds: List[torch.Tensor], max_new_tokens: int
+    ) -> List[List[int]]:
+        seq_len = max(len(embeds) for embeds in prompts_embeds)
+        inputs_embeds = torch.zeros(
+            len(prompts_embeds), seq_len, prompts_embeds[0].shape[-1]
+        )
+        attention_mask = torch.zeros(len(prompts_embeds), seq_len, dtype=torch.long)
+        for i, embeds in enumerate(prompts_embeds):
+            inputs_embeds[i, seq_len - len(embeds) :] = embeds
+            attention_mask[i, seq_len - len(embeds) :] = 1
+        outputs = language_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=eos_token_id,
+            pad_token_id=eos_token_id,
+        )
+        return outputs.tolist()
+
+    # static batches: every request of a batch waits for the longest one
+    start = time.perf_counter()
+    static_outputs, static_latencies = [], []
+    for i in range(0, n_requests, batch_size):
+        budgets = max_new_tokens[i : i + batch_size]
+        outputs = generate(prompts[i : i + batch_size], max(budgets))
+        elapsed = time.perf_counter() - start
+        static_outputs.extend(
+            output[:budget] for output, budget in zip(outputs, budgets)
+        )
+        static_latencies.extend([elapsed] * len(budgets))
+
+    def run_engine(kv_cache: Optional[PagedKVCache] = None):
+        engine = ContinuousBatchingEngine(
+            language_model,
+            eos_token_id,
+            max_running=batch_size,
+            max_prefill_size=2,
+            kv_cache=kv_cache,
+        )
+        engine.start()
+        start = time.perf_counter()
+        futures = [
+            engine.submit(p, n, prefix_ids=prefix_ids)
+            for p, n in zip(prompts, max_new_tokens)
+        ]
+        latencies = []
+        for future in futures:
+            future.add_done_callback(
+                lambda _: latencies.append(time.perf_counter() - start)
+            )
+        outputs = [future.result() for future in futures]
+        engine.stop()
+
+        for static_output, output in zip(static_outputs, outputs):
+            # generate pads the sequences that stopped at EOS
+            assert static_output[: len(output)] == output
+        return latencies, engine.stats()
+
+    engine_latencies, engine_stats = run_engine()
+    # a pool of KV cache blocks for 8 sequences of 720 tokens, a token takes the keys
+    # and the values of 4 layers of 256 fp32 channels. It skips the prefills of the
+    # shared prefix, its decode steps are not faster than the padded cache ones.
+    paged_latencies, paged_stats = run_engine(
+        PagedKVCache.from_config(
+            config.language_config, max_bytes=8 * 720 * (2 * 4 * 256 * 4), block_size=16
+        )
+    )
+
+    for name, latencies in [
+        ("static", static_latencies),
+        ("engine", engine_latencies),
+        ("engine, paged KV cache", paged_latencies),
+    ]:
+        latencies = sorted(latencies)
+        print(
+            f"{name}: mean {sum(latencies) / len(latencies):.2f}s, "
+            f"p90 {latencies[int(0.9 * len(latencies))]:.2f}s, "
+            f"total {latencies[-1]:.2f}s"
+        )
+    print(engine_stats)
+    print(paged_stats)
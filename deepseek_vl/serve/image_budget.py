@@ -0,0 +1,188 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+from PIL import Image, ImageMode
+
+from deepseek_vl.models.image_processing_vlm import draft_image, to_pil_image
+
+
+class ImageTooLargeError(ValueError):
+    """The image exceeds the configured pixel or byte budget."""
+
+
+class MemoryBudget(object):
+    """
+    Bounds the bytes held by concurrent image decodes. A decode reserves the size of its
+    decoded pixels before it starts, and waits while the reservations of the other decodes
+    would exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): the ceiling of the bytes reserved at the same time.
+        """
+
+        self.max_bytes = max_bytes
+
+        self._in_flight = 0
+        self._peak = 0
+        self._waits = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None):
+        """
+        Args:
+            nbytes (int): the bytes to reserve.
+            timeout (float, optional): seconds to wait for the reservation. Defaults to forever.
+        """
+
+        if nbytes > self.max_bytes:
+            raise ImageTooLargeError(
+                f"Decoding needs {nbytes} bytes, more than the budget of {self.max_bytes}"
+            )
+
+        with self._condition:
+            if self._in_flight + nbytes > self.max_bytes:
+                self._waits += 1
+            if not self._condition.wait_for(
+                lambda: self._in_flight + nbytes <= self.max_bytes, timeout=timeout
+            ):
+                raise TimeoutError("Timed out waiting for the image decode budget")
+            self._in_flight += nbytes
+            self._peak = max(self._peak, self._in_flight)
+
+    def release(self, nbytes: int):
+        with self._condition:
+            self._in_flight -= nbytes
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int, timeout: Optional[float] = None):
+        self.acquire(nbytes, timeout=timeout)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(
+                max_bytes=self.max_bytes,
+                in_flight=self._in_flight,
+                peak=self._peak,
+                waits=self._waits,
+            )
+
+
+def _encoded_size(image_data: Union[bytes, BinaryIO]) -> int:
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return len(image_data)
+    position = image_data.tell()
+    image_data.seek(0, os.SEEK_END)
+    size = image_data.tell() - position
+    image_data.seek(position)
+    return size
+
+
+def _bytes_per_pixel(mode: str) -> int:
+    mode = ImageMode.getmode(mode)
+    nbytes = len(mode.bands) * int(mode.typestr[-1])
+    # PIL pads the pixels of the 3-band modes to 4 bytes
+    return 4 if nbytes == 3 else nbytes
+
+
+def decode_image(
+    image_data: Union[bytes, BinaryIO],
+    max_size: Optional[int] = None,
+    max_pixels: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    budget: Optional[MemoryBudget] = None,
+    resize: Optional[Callable[[Image.Image], Image.Image]] = None,
+) -> Image.Image:
+    """
+    Decode an image file after checking its header against the budgets.
+
+    Images with more than `max_pixels` pixels are decoded at a reduced scale when the format
+    allows it (JPEG), and rejected otherwise. The decoded bytes are reserved from `budget`
+    while the image is decoded, converted to RGB and, when its longer side exceeds
+    `max_size`, downscaled with `resize`: only the downscaled image outlives the reservation.
+
+    Args:
+        image_data (Union[bytes, BinaryIO]): the encoded bytes of an image file or a binary file.
+        max_size (int, optional): the size of the longer side the image will be resized to.
+        max_pixels (int, optional): the largest number of decoded pixels.
+        max_bytes (int, optional): the largest encoded file size.
+        budget (MemoryBudget, optional): the shared budget of in-flight decoded bytes.
+        resize (Callable, optional): downscales an RGB image to `max_size`, e.g.
+            `VLMImageProcessor.resize_keep_ratio`.
+
+    Returns:
+        pil_img (PIL.Image): the image in RGB.
+
+    Raises:
+        ImageTooLargeError: if the image is over budget.
+    """
+
+    encoded_size = _encoded_size(image_data)
+    if max_bytes is not None and encoded_size > max_bytes:
+        raise ImageTooLargeError(
+            f"Image file of {encoded_size} bytes exceeds the limit of {max_bytes} bytes"
+        )
+
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        image_data = BytesIO(image_data)
+
+    # only reads the header
+    image = Image.open(image_data)
+    width, height = image.size
+    image = draft_image(image, max_size=max_size, max_pixels=max_pixels)
+    if max_pixels is not None and image.width * image.height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image of {width}x{height} pixels exceeds the limit of {max_pixels} pixels"
+        )
+
+    # the decoded pixels, plus a copy if they have to be converted to RGB, plus the
+    # downscaled copy
+    downscale = (
+        resize is not None and max_size is not None and max(image.size) > max_size
+    )
+    pixels = image.width * image.height
+    nbytes = pixels * _bytes_per_pixel(image.mode)
+    if image.mode != "RGB":
+        nbytes += pixels * _bytes_per_pixel("RGB")
+    if downscale:
+        nbytes += max_size * max_size * _bytes_per_pixel("RGB")
+
+    def load() -> Image.Image:
+        image.load()
+        rgb_image = to_pil_image(image)
+        return resize(rgb_image) if downscale else rgb_image
+
+    if budget is None:
+        return load()
+
+    with budget.reserve(nbytes):
+        return load()
@@ -17,8 +17,9 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from threading import Thread
-from typing import List
+import asyncio
+from threading import Event, Thread
+from typing import List, Optional
 
 import torch
 import transformers
@@ -27,19 +28,29 @@ from transformers import (
     StoppingCriteria,
     StoppingCriteriaList,
     TextIteratorStreamer,
+    TextStreamer,
 )
+from transformers.generation.streamers import BaseStreamer
 
 from deepseek_vl.models import MultiModalityCausalLM, VLChatProcessor
+from deepseek_vl.serve.speculative import (
+    PhraseTrie,
+    PromptLookupProposer,
+    speculative_generate,
+)
 from deepseek_vl.utils.conversation import Conversation
 
 
-def load_model(model_path):
+def load_model(model_path, images_embeds_cache_bytes: int = 0):
     vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(model_path)
     tokenizer = vl_chat_processor.tokenizer
     vl_gpt: MultiModalityCausalLM = AutoModelForCausalLM.from_pretrained(
         model_path, trust_remote_code=True
     )
     vl_gpt = vl_gpt.to(torch.bfloat16).cuda().eval()
+    if images_embeds_cache_bytes > 0:
+        # the chat history re-sends the earlier images on every turn
+        vl_gpt.enable_images_embeds_cache(max_device_bytes=images_embeds_cache_bytes)
     return tokenizer, vl_gpt, vl_chat_processor
 
 
@@ -80,6 +91,136 @@ class StoppingCriteriaSub(StoppingCriteria):
         return False
 
 
+class CancellationCriteria(StoppingCriteria):
+    """Stops the generation of each sequence once its `cancel_event` is set."""
+
+    def __init__(self, cancel_events: List[Optional[Event]]):
+        """
+        Args:
+            cancel_events (List[Optional[Event]]): one per sequence of the batch, None
+                for the sequences that cannot be cancelled.
+        """
+
+        super().__init__()
+        self.cancel_events = cancel_events
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        return torch.tensor(
+            [event is not None and event.is_set() for event in self.cancel_events],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Streamer whose text is read with `async for` on an asyncio event loop, while the
+    tokens are put from the generation thread. Waiting for the text takes no thread.
+    """
+
+    def __init__(
+        self,
+        tokenizer: transformers.PreTrainedTokenizer,
+        loop: asyncio.AbstractEventLoop,
+        skip_prompt: bool = False,
+        **decode_kwargs,
+    ):
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.loop = loop
+        self.text_queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        self.ended = False
+
+    def end(self):
+        # may be ended by the generation and by the consumer giving up, only once
+        if not self.ended:
+            self.ended = True
+            super().end()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        text = await self.text_queue.get()
+        if text is None:
+            raise StopAsyncIteration()
+        return text
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Sends the tokens `generate` puts for a batch to one streamer per sequence. A
+    sequence's streamer ends after its EOS or its own `max_new_tokens`, the padding
+    `generate` adds after that is dropped.
+    """
+
+    def __init__(
+        self,
+        streamers: List[Optional[BaseStreamer]],
+        max_new_tokens: List[int],
+        eos_token_id: int,
+    ):
+        """
+        Args:
+            streamers (List[Optional[BaseStreamer]]): one per sequence of the batch,
+                None for the sequences that are not streamed.
+            max_new_tokens (List[int]): the generation budget of each sequence.
+            eos_token_id (int): ends a sequence.
+        """
+
+        self.streamers = list(streamers)
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.n_tokens = [0] * len(streamers)
+        self.prompt_done = False
+
+    def put(self, value: torch.LongTensor):
+        """
+
+        Args:
+            value (torch.LongTensor): the prompt first, then [b] or [b, n] new tokens.
+        """
+
+        if not self.prompt_done:
+            # the streamers may skip the prompt, they all get an empty one
+            self.prompt_done = True
+            for streamer in self.streamers:
+                if streamer is not None:
+                    streamer.put(torch.empty(0, dtype=torch.long))
+            return
+
+        if value.dim() == 1:
+            value = value[:, None]
+        for i, (streamer, token_ids) in enumerate(zip(self.streamers, value.tolist())):
+            if streamer is None:
+                continue
+            token_ids = token_ids[: self.max_new_tokens[i] - self.n_tokens[i]]
+            if self.eos_token_id in token_ids:
+                token_ids = token_ids[: token_ids.index(self.eos_token_id) + 1]
+            self.n_tokens[i] += len(token_ids)
+            if len(token_ids) > 0:
+                streamer.put(torch.tensor(token_ids))
+            if (
+                self.n_tokens[i] >= self.max_new_tokens[i]
+                or self.eos_token_id in token_ids
+            ):
+                streamer.end()
+                self.streamers[i] = None
+
+    def end(self):
+        for i, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.end()
+                self.streamers[i] = None
+
+
 @torch.inference_mode()
 def deepseek_generate(
     prompts: list,
@@ -91,6 +232,7 @@ def deepseek_generate(
     temperature: float = 1.0,
     top_p: float = 1.0,
     repetition_penalty=1.1,
+    phrase_trie: Optional[PhraseTrie] = None,
 ):
     prompts = prompts
     pil_images = list()
@@ -113,6 +255,7 @@ def deepseek_generate(
         repetition_penalty,
         top_p,
         stop_words,
+        phrase_trie=phrase_trie,
     )
 
 
@@ -126,8 +269,16 @@ def generate(
     repetition_penalty=1.1,
     top_p: float = 0.95,
     stop_words: List[str] = [],
+    phrase_trie: Optional[PhraseTrie] = None,
+    num_speculative_tokens: int = 4,
 ):
-    """Stream the text output from the multimodality model with prompt and image inputs."""
+    """
+    Stream the text output from the multimodality model with prompt and image inputs.
+
+    With `phrase_trie` and greedy decoding, the continuations of the last tokens found in
+    the prompt, the phrases or the earlier responses are verified `num_speculative_tokens`
+    at a time, and the response is added to `phrase_trie`.
+    """
     inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
 
     streamer = TextIteratorStreamer(tokenizer)
@@ -164,7 +315,29 @@ def generate(
     else:
         generation_config["do_sample"] = False
 
-    thread = Thread(target=vl_gpt.language_model.generate, kwargs=generation_config)
+    if phrase_trie is not None and not generation_config["do_sample"]:
+        # the text of the prompt, without the image tokens
+        prompt_ids = prepare_inputs.input_ids[0][~prepare_inputs.images_seq_mask[0]]
+        proposer = PromptLookupProposer(phrase_trie, [prompt_ids.tolist()])
+
+        def speculative_decode():
+            outputs = speculative_generate(
+                vl_gpt.language_model,
+                proposer,
+                prepare_inputs.attention_mask,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id,
+                max_new_tokens=max_gen_len,
+                inputs_embeds=inputs_embeds,
+                num_speculative_tokens=num_speculative_tokens,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+            )
+            phrase_trie.add(outputs[0].tolist())
+
+        thread = Thread(target=speculative_decode)
+    else:
+        thread = Thread(target=vl_gpt.language_model.generate, kwargs=generation_config)
     thread.start()
 
     yield from streamer
@@ -0,0 +1,461 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import LlamaConfig
+from transformers.cache_utils import Cache
+
+# per layer, the keys and the values of a batch, [b, n_heads, n_tokens, head_dim]
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class BlockAllocator(object):
+    """
+    Free list of fixed-size KV blocks, with a reference count per block.
+
+    A released block that holds a cached prompt prefix is not freed: it stays cached,
+    and is reused by the next sequence with the same prefix. Cached blocks are only
+    taken back once the free list is empty, least recently released first.
+    """
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+
+        self._free: List[int] = list(reversed(range(num_blocks)))
+        self._cached: "OrderedDict[int, None]" = OrderedDict()
+        self._refcounts = [0] * num_blocks
+
+    @property
+    def num_free(self) -> int:
+        """The blocks that can be allocated, cached ones included."""
+        return len(self._free) + len(self._cached)
+
+    @property
+    def num_cached(self) -> int:
+        return len(self._cached)
+
+    def refcount(self, block: int) -> int:
+        return self._refcounts[block]
+
+    def allocate(self) -> int:
+        if len(self._free) > 0:
+            block = self._free.pop()
+        elif len(self._cached) > 0:
+            block, _ = self._cached.popitem(last=False)
+        else:
+            raise RuntimeError("No free KV cache block left.")
+
+        self._refcounts[block] = 1
+        return block
+
+    def share(self, block: int):
+        if self._refcounts[block] == 0:
+            del self._cached[block]
+        self._refcounts[block] += 1
+
+    def release(self, block: int, cached: bool = False):
+        """
+
+        Args:
+            block (int): a block allocated or shared before.
+            cached (bool): keep its content for reuse once it is not referenced anymore.
+        """
+
+        assert self._refcounts[block] > 0, f"Block {block} is not allocated."
+        self._refcounts[block] -= 1
+        if self._refcounts[block] > 0:
+            return
+        if cached:
+            self._cached[block] = None
+        else:
+            self._free.append(block)
+
+
+class PagedKVCache(object):
+    """
+    Block-allocated KV cache of the language model, for many sequences at once.
+
+    The keys and values of all the sequences live in one pool of `num_blocks` blocks of
+    `block_size` tokens per layer. Each sequence has a block table, the list of its
+    blocks in order, and grows one block at a time: no contiguous per-sequence tensor,
+    so no fragmentation beyond the last, partly filled block of each sequence.
+
+    Full blocks of the text a prompt starts with (`prefix_ids`, e.g. the system prompt)
+    are keyed by a hash of all the tokens up to their end. Sequences with the same
+    prefix share these blocks, reference counted, and skip their prefill. The blocks
+    stay cached after the last sequence using them is done, until the pool runs out.
+
+    A sequence reserves the blocks of its prompt and of its `max_new_tokens` when it
+    starts, so running sequences never run out of blocks.
+
+    This is a reference layout, there is no paged-attention kernel: every decode step
+    gathers the blocks of each sequence back into a padded dense tensor per layer (see
+    `PagedCacheStep`). It saves memory and prefix prefills, not decode time.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        num_kv_heads: int,
+        head_dim: int,
+        num_blocks: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: Union[str, torch.device] = "cpu",
+    ):
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+
+        # [num_blocks x block_size, n_heads, head_dim] per layer, one row per token slot
+        shape = (num_blocks * block_size, num_kv_heads, head_dim)
+        self.key_cache = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+        self.value_cache = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+
+        self.allocator = BlockAllocator(num_blocks)
+        self._block_tables: Dict[int, List[int]] = {}
+        self._lengths: Dict[int, int] = {}
+        self._reserved: Dict[int, int] = {}
+        self._n_reserved = 0
+        self._prefix_hashes: Dict[int, List[int]] = {}
+        self._hash_to_block: Dict[int, int] = {}
+        self._block_to_hash: Dict[int, int] = {}
+        self._next_seq_id = 0
+        self._counters = dict(
+            sequences=0,
+            prefix_hit_tokens=0,
+            prefix_evictions=0,
+            peak_used_blocks=0,
+        )
+
+    @classmethod
+    def from_config(
+        cls,
+        config: LlamaConfig,
+        max_bytes: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: Union[str, torch.device] = "cpu",
+    ) -> "PagedKVCache":
+        """
+
+        Args:
+            config (LlamaConfig): the config of the language model.
+            max_bytes (int): memory budget of the pool of blocks.
+            block_size (int): the number of tokens per block.
+
+        Returns:
+            kv_cache (PagedKVCache): with as many blocks as fit in `max_bytes`.
+        """
+
+        head_dim = config.hidden_size // config.num_attention_heads
+        num_kv_heads = config.num_key_value_heads or config.num_attention_heads
+        block_bytes = (
+            2
+            * config.num_hidden_layers
+            * block_size
+            * num_kv_heads
+            * head_dim
+            * torch.empty(0, dtype=dtype).element_size()
+        )
+        return cls(
+            config.num_hidden_layers,
+            num_kv_heads,
+            head_dim,
+            num_blocks=max_bytes // block_bytes,
+            block_size=block_size,
+            dtype=dtype,
+            device=device,
+        )
+
+    def _hash_blocks(self, prefix_ids: Sequence[int]) -> List[int]:
+        hashes, h = [], None
+        for start in range(0, len(prefix_ids) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(prefix_ids[start : start + self.block_size])))
+            hashes.append(h)
+        return hashes
+
+    def allocate(
+        self, n_tokens: int, max_new_tokens: int, prefix_ids: Sequence[int] = ()
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Starts a sequence, sharing the cached blocks of its prefix.
+
+        Args:
+            n_tokens (int): the prompt length.
+            max_new_tokens (int): the generation budget, reserved up front.
+            prefix_ids (Sequence[int]): the token ids the prompt starts with.
+
+        Returns:
+            seq_id (int): the id of the sequence, None if the free blocks are not enough.
+            n_shared (int): the prompt tokens whose keys and values are already cached.
+        """
+
+        n_blocks = math.ceil((n_tokens + max_new_tokens) / self.block_size)
+        if n_blocks > self.num_blocks:
+            raise ValueError(
+                f"A sequence of {n_tokens} + {max_new_tokens} tokens needs {n_blocks} "
+                f"KV cache blocks, more than the {self.num_blocks} of the cache."
+            )
+
+        # leave the last prompt token out, the prefill needs at least one input
+        hashes = self._hash_blocks(list(prefix_ids)[: n_tokens - 1])
+        shared = []
+        for h in hashes:
+            block = self._hash_to_block.get(h)
+            if block is None:
+                break
+            shared.append(block)
+
+        # the cached blocks shared again are no longer free
+        n_free = self.allocator.num_free - self._n_reserved
+        n_free -= sum(1 for block in shared if self.allocator.refcount(block) == 0)
+        if n_blocks - len(shared) > n_free:
+            return None
+
+        for block in shared:
+            self.allocator.share(block)
+
+        seq_id = self._next_seq_id
+        self._next_seq_id += 1
+        self._block_tables[seq_id] = shared
+        self._lengths[seq_id] = len(shared) * self.block_size
+        self._reserved[seq_id] = n_blocks - len(shared)
+        self._n_reserved += n_blocks - len(shared)
+        self._prefix_hashes[seq_id] = hashes
+
+        self._counters["sequences"] += 1
+        self._counters["prefix_hit_tokens"] += self._lengths[seq_id]
+        self._update_peak()
+        return seq_id, self._lengths[seq_id]
+
+    def free(self, seq_id: int):
+        for block in self._block_tables.pop(seq_id):
+            self.allocator.release(block, cached=block in self._block_to_hash)
+        self._n_reserved -= self._reserved.pop(seq_id)
+        del self._lengths[seq_id]
+        del self._prefix_hashes[seq_id]
+
+    def length(self, seq_id: int) -> int:
+        return self._lengths[seq_id]
+
+    def _allocate_block(self, seq_id: int) -> int:
+        block = self.allocator.allocate()
+
+        # a cached block taken back
+        h = self._block_to_hash.pop(block, None)
+        if h is not None:
+            del self._hash_to_block[h]
+            self._counters["prefix_evictions"] += 1
+
+        if self._reserved[seq_id] > 0:
+            self._reserved[seq_id] -= 1
+            self._n_reserved -= 1
+        self._update_peak()
+        return block
+
+    def _update_peak(self):
+        used = self.num_blocks - self.allocator.num_free
+        self._counters["peak_used_blocks"] = max(
+            self._counters["peak_used_blocks"], used
+        )
+
+    def _slots(self, seq_id: int, start: int, end: int) -> torch.LongTensor:
+        """The slots of the tokens [start, end) of a sequence, allocating its blocks."""
+
+        block_table = self._block_tables[seq_id]
+        while len(block_table) * self.block_size < end:
+            block_table.append(self._allocate_block(seq_id))
+
+        positions = torch.arange(start, end)
+        blocks = torch.tensor(block_table, dtype=torch.long)[
+            positions // self.block_size
+        ]
+        return blocks * self.block_size + positions % self.block_size
+
+    def store(self, seq_id: int, start: int, past_key_values: LegacyCache):
+        """
+        Writes the keys and values of the tokens [start, start + n) of a sequence. The
+        tokens already cached, the shared prefix, are skipped.
+
+        Args:
+            seq_id (int): the sequence.
+            start (int): the position of the first token.
+            past_key_values (LegacyCache): [n_heads, n, head_dim] per layer.
+        """
+
+        end = start + past_key_values[0][0].shape[1]
+        skip = max(self._lengths[seq_id] - start, 0)
+        if start + skip < end:
+            slots = self._slots(seq_id, start + skip, end).to(self.key_cache[0].device)
+            for layer, (k, v) in enumerate(past_key_values):
+                self.key_cache[layer][slots] = k[:, skip:].transpose(0, 1)
+                self.value_cache[layer][slots] = v[:, skip:].transpose(0, 1)
+        self._lengths[seq_id] = max(self._lengths[seq_id], end)
+
+        # the prefix blocks filled up for the first time become shareable
+        block_table = self._block_tables[seq_id]
+        for i, h in enumerate(self._prefix_hashes[seq_id]):
+            if (i + 1) * self.block_size > self._lengths[seq_id]:
+                break
+            if (
+                h not in self._hash_to_block
+                and block_table[i] not in self._block_to_hash
+            ):
+                self._hash_to_block[h] = block_table[i]
+                self._block_to_hash[block_table[i]] = h
+
+    def gather(self, seq_ids: List[int], n_tokens: int) -> LegacyCache:
+        """
+
+        Args:
+            seq_ids (List[int]): the sequences, all with at least `n_tokens` tokens.
+            n_tokens (int): the number of leading tokens to read.
+
+        Returns:
+            past_key_values (LegacyCache): [b, n_heads, n_tokens, head_dim] per layer.
+        """
+
+        slots = torch.stack([self._slots(seq_id, 0, n_tokens) for seq_id in seq_ids])
+        slots = slots.to(self.key_cache[0].device)
+        return tuple(
+            (k[slots].permute(0, 2, 1, 3), v[slots].permute(0, 2, 1, 3))
+            for k, v in zip(self.key_cache, self.value_cache)
+        )
+
+    def step(self, seq_ids: List[int]) -> Tuple["PagedCacheStep", torch.LongTensor]:
+        """
+        Appends one token to each sequence, for a decode step of the language model.
+
+        Args:
+            seq_ids (List[int]): the sequences of the batch.
+
+        Returns:
+            past_key_values (PagedCacheStep): the cache to pass to the language model.
+            attention_mask (torch.LongTensor): [b, L + 1], the sequences are left-padded
+                to the longest one, L tokens.
+        """
+
+        lengths = [self._lengths[seq_id] for seq_id in seq_ids]
+        past_length = max(lengths)
+        device = self.key_cache[0].device
+
+        write_slots = torch.stack(
+            [self._slots(seq_id, n, n + 1) for seq_id, n in zip(seq_ids, lengths)]
+        )
+        # the padding reads slot 0, it is masked out
+        read_slots = torch.zeros(len(seq_ids), past_length + 1, dtype=torch.long)
+        attention_mask = torch.zeros(len(seq_ids), past_length + 1, dtype=torch.long)
+        for i, (seq_id, n) in enumerate(zip(seq_ids, lengths)):
+            read_slots[i, past_length - n :] = self._slots(seq_id, 0, n + 1)
+            attention_mask[i, past_length - n :] = 1
+            self._lengths[seq_id] = n + 1
+
+        past_key_values = PagedCacheStep(
+            self, write_slots.to(device), read_slots.to(device), past_length
+        )
+        return past_key_values, attention_mask.to(device)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        used_blocks = self.num_blocks - self.allocator.num_free
+        n_tokens = sum(self._lengths.values())
+        stats = dict(self._counters)
+        stats.update(
+            num_blocks=self.num_blocks,
+            block_size=self.block_size,
+            used_blocks=used_blocks,
+            free_blocks=self.allocator.num_free - self.allocator.num_cached,
+            cached_blocks=self.allocator.num_cached,
+            reserved_blocks=self._n_reserved,
+            shared_blocks=sum(
+                1
+                for block in range(self.num_blocks)
+                if self.allocator.refcount(block) > 1
+            ),
+            running_sequences=len(self._block_tables),
+            tokens=n_tokens,
+            # the blocks in use, and the slots of these blocks holding a token
+            utilization=used_blocks / self.num_blocks,
+            slot_utilization=n_tokens / max(used_blocks * self.block_size, 1),
+        )
+        return stats
+
+
+class PagedCacheStep(Cache):
+    """
+    The `past_key_values` of one forward of the language model over a batch of
+    sequences of a `PagedKVCache`: each layer writes the keys and values of the new
+    tokens to their slots, and attends to the gathered, left-padded sequences.
+
+    The gather copies the whole KV of every sequence into a new [b, n_heads, L + q,
+    head_dim] tensor, for each layer and at every step, through an indexed read of
+    scattered slots. A paged-attention kernel would read the blocks in place; without
+    one, the decode steps are no faster than with the padded cache.
+    """
+
+    def __init__(
+        self,
+        kv_cache: PagedKVCache,
+        write_slots: torch.LongTensor,
+        read_slots: torch.LongTensor,
+        past_length: int,
+    ):
+        """
+        Args:
+            kv_cache (PagedKVCache): the pool of blocks.
+            write_slots (torch.LongTensor): [b, q], the slots of the new tokens.
+            read_slots (torch.LongTensor): [b, L + q], the slots of the padded sequences.
+            past_length (int): L, the padded length before the new tokens.
+        """
+
+        super().__init__()
+        self.kv_cache = kv_cache
+        self.write_slots = write_slots
+        self.read_slots = read_slots
+        self.past_length = past_length
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.past_length
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return None
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        key_cache = self.kv_cache.key_cache[layer_idx]
+        value_cache = self.kv_cache.value_cache[layer_idx]
+        key_cache[self.write_slots] = key_states.transpose(1, 2)
+        value_cache[self.write_slots] = value_states.transpose(1, 2)
+        return (
+            key_cache[self.read_slots].permute(0, 2, 1, 3),
+            value_cache[self.read_slots].permute(0, 2, 1, 3),
+        )
@@ -0,0 +1,371 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache, LlamaForCausalLM
+
+# per layer, the keys and the values of one sequence, [1, n_heads, n_tokens, head_dim]
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def text_prefix(input_ids: Sequence[int], image_id: int) -> List[int]:
+    """
+
+    Args:
+        input_ids (Sequence[int]): the token ids of a prompt.
+        image_id (int): the token id of the image placeholders.
+
+    Returns:
+        prefix (List[int]): the token ids before the first image token.
+    """
+
+    input_ids = list(input_ids)
+    if image_id in input_ids:
+        return input_ids[: input_ids.index(image_id)]
+    return input_ids
+
+
+def shared_prefix(batch_input_ids: Sequence[Sequence[int]], image_id: int) -> List[int]:
+    """
+    The longest text prefix common to all the prompts of a batch. It always leaves at
+    least the last token of every prompt out, which `generate` needs as input.
+
+    Args:
+        batch_input_ids (Sequence[Sequence[int]]): the unpadded token ids of every prompt.
+        image_id (int): the token id of the image placeholders.
+
+    Returns:
+        prefix (List[int]): the shared token ids.
+    """
+
+    prefix = None
+    for input_ids in batch_input_ids:
+        row = text_prefix(input_ids, image_id)[: len(input_ids) - 1]
+        if prefix is None:
+            prefix = row
+            continue
+
+        n = 0
+        for a, b in zip(prefix, row):
+            if a != b:
+                break
+            n += 1
+        prefix = prefix[:n]
+
+    return prefix or []
+
+
+class _Node(object):
+    __slots__ = ("children", "entry")
+
+    def __init__(self):
+        self.children: Dict[int, "_Node"] = {}
+        # the longest cached sequence through this node, its KV covers this prefix
+        self.entry: Optional[_Entry] = None
+
+
+class _Entry(object):
+    __slots__ = ("token_ids", "past_key_values", "nbytes")
+
+    def __init__(self, token_ids: Tuple[int, ...], past_key_values: LegacyCache):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = sum(
+            t.numel() * t.element_size() for layer in past_key_values for t in layer
+        )
+
+
+class PrefixKVCache(object):
+    """
+    Prefix tree of token ids whose paths hold the KV cache of the language model, so
+    prompts that start alike, e.g. with the system prompt and the role tag of the chat
+    template, only prefill the tokens after their longest cached prefix.
+
+    Only text tokens are cached: the keys and values after an image depend on its pixels.
+    A cached sequence also serves the prefixes of it, by slicing its KV. Sequences are
+    evicted least recently used first once they hold more than `max_bytes`.
+
+    The cache is cleared when the `fingerprint` given to `validate` changes (e.g. the
+    checkpoint path or the system prompt), and when the weights of the language model
+    are replaced or modified in place.
+    """
+
+    def __init__(
+        self,
+        language_model: LlamaForCausalLM,
+        max_bytes: int = 512 << 20,
+        fingerprint: Hashable = None,
+    ):
+        """
+        Args:
+            language_model (LlamaForCausalLM): the model the keys and values come from.
+            max_bytes (int): memory budget of the cached keys and values.
+            fingerprint (Hashable, optional): identifies what the cached prompts are
+                built from, see `validate`.
+        """
+
+        self.language_model = language_model
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+
+        self._root = _Node()
+        self._entries: "OrderedDict[Tuple[int, ...], _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._weights_version = self._get_weights_version()
+        self._lock = threading.Lock()
+        self._counters = dict(
+            hits=0,
+            misses=0,
+            cached_tokens=0,
+            computed_tokens=0,
+            evictions=0,
+            invalidations=0,
+        )
+
+    def _get_weights_version(self) -> Tuple[Tuple[int, int], ...]:
+        return tuple(
+            (p.data_ptr(), p._version) for p in self.language_model.parameters()
+        )
+
+    def validate(self, fingerprint: Hashable = None):
+        """
+        Clears the cache if `fingerprint` or the weights of the language model changed
+        since the cache was filled.
+
+        Args:
+            fingerprint (Hashable, optional): e.g. the checkpoint path and the system prompt.
+        """
+
+        weights_version = self._get_weights_version()
+        with self._lock:
+            if (
+                fingerprint == self.fingerprint
+                and weights_version == self._weights_version
+            ):
+                return
+
+            self.fingerprint = fingerprint
+            self._weights_version = weights_version
+            if len(self._entries) > 0:
+                self._clear()
+                self._counters["invalidations"] += 1
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, Optional[LegacyCache]]:
+        """
+
+        Args:
+            token_ids (Sequence[int]): the prompt token ids.
+
+        Returns:
+            n_cached (int): the length of the longest cached prefix of `token_ids`.
+            past_key_values (LegacyCache, optional): the KV cache of these n_cached tokens.
+        """
+
+        with self._lock:
+            node, depth = self._root, 0
+            for token_id in token_ids:
+                child = node.children.get(token_id)
+                if child is None:
+                    break
+                node, depth = child, depth + 1
+
+            if depth == 0:
+                return 0, None
+
+            entry = node.entry
+            self._entries.move_to_end(entry.token_ids)
+            return depth, _slice(entry.past_key_values, depth)
+
+    @torch.inference_mode()
+    def get(self, token_ids: Sequence[int]) -> LegacyCache:
+        """
+        The KV cache of `token_ids`, only the tokens after the longest cached prefix go
+        through the language model.
+
+        Args:
+            token_ids (Sequence[int]): the prompt token ids, text tokens only.
+
+        Returns:
+            past_key_values (LegacyCache): the keys and values of every layer, [1, h, n, d].
+        """
+
+        token_ids = tuple(token_ids)
+        n_cached, past_key_values = self.match(token_ids)
+        n_computed = len(token_ids) - n_cached
+
+        with self._lock:
+            self._counters["hits" if n_cached > 0 else "misses"] += 1
+            self._counters["cached_tokens"] += n_cached
+            self._counters["computed_tokens"] += n_computed
+
+        if n_computed == 0:
+            return past_key_values
+
+        device = self.language_model.get_input_embeddings().weight.device
+        outputs = self.language_model.model(
+            input_ids=torch.tensor([token_ids[n_cached:]], device=device),
+            past_key_values=DynamicCache.from_legacy_cache(past_key_values),
+            use_cache=True,
+        )
+        past_key_values = outputs.past_key_values.to_legacy_cache()
+
+        with self._lock:
+            self._insert(_Entry(token_ids, past_key_values))
+        return past_key_values
+
+    def _insert(self, entry: _Entry):
+        if entry.nbytes > self.max_bytes or entry.token_ids in self._entries:
+            return
+
+        node = self._root
+        for depth, token_id in enumerate(entry.token_ids, start=1):
+            node = node.children.setdefault(token_id, _Node())
+            # a sequence that ends on the path is a slice of the new one
+            if node.entry is not None and len(node.entry.token_ids) == depth:
+                self._remove(node.entry, prune=False)
+            node.entry = entry
+
+        self._entries[entry.token_ids] = entry
+        self._bytes += entry.nbytes
+
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries.values())), prune=True)
+            self._counters["evictions"] += 1
+
+    def _remove(self, entry: _Entry, prune: bool):
+        del self._entries[entry.token_ids]
+        self._bytes -= entry.nbytes
+        if not prune:
+            return
+
+        # walk the path back up: the nodes still shared with other sequences take over
+        # the entry of one of their children, the others are dropped
+        path = [self._root]
+        for token_id in entry.token_ids:
+            path.append(path[-1].children[token_id])
+
+        for depth in range(len(entry.token_ids), 0, -1):
+            node = path[depth]
+            if node.entry is not entry:
+                break
+            if node.children:
+                node.entry = next(iter(node.children.values())).entry
+            else:
+                del path[depth - 1].children[entry.token_ids[depth - 1]]
+
+    def _clear(self):
+        self._root = _Node()
+        self._entries.clear()
+        self._bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    @torch.inference_mode()
+    def prefill(
+        self,
+        prefix_ids: Sequence[int],
+        input_ids: torch.LongTensor,
+        inputs_embeds: torch.Tensor,
+        attention_mask: torch.LongTensor,
+    ) -> Dict[str, object]:
+        """
+        Prefill a left-padded batch whose prompts all start with `prefix_ids`, reusing the
+        cached KV of the prefix. The cache is laid out as [prefix, padding, rest of the
+        prompt]: the padding is masked out and the positions follow the attention mask, so
+        the generation is the same as from the left-padded batch.
+
+        Args:
+            prefix_ids (Sequence[int]): the shared text prefix, see `shared_prefix`.
+            input_ids (torch.LongTensor): [b, T], the token ids of the prompts.
+            inputs_embeds (torch.Tensor): [b, T, D], the embeddings of the prompts.
+            attention_mask (torch.LongTensor): [b, T], left padding.
+
+        Returns:
+            generate_inputs (Dict[str, object]): the `input_ids`, `attention_mask` and
+                `past_key_values` to pass to `generate`, in the layout above. Only the
+                last token of every prompt is left out of `past_key_values`.
+        """
+
+        batch_size, seq_len, _ = inputs_embeds.shape
+        n_prefix = len(prefix_ids)
+        device = inputs_embeds.device
+
+        past_key_values = self.get(prefix_ids)
+        cache = DynamicCache.from_legacy_cache(
+            tuple(
+                (k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+                for k, v in past_key_values
+            )
+        )
+
+        # drop the prefix tokens from every row, they follow the left padding
+        n_padding = seq_len - attention_mask.sum(dim=1, keepdim=True)
+        columns = torch.arange(seq_len - n_prefix, device=device)[None, :]
+        columns = columns + (columns >= n_padding) * n_padding.new_tensor(n_prefix)
+        rest_embeds = torch.gather(
+            inputs_embeds,
+            1,
+            columns[:, :, None].expand(-1, -1, inputs_embeds.shape[-1]),
+        )
+        input_ids = torch.cat(
+            [
+                torch.tensor(prefix_ids, device=device).expand(batch_size, -1),
+                input_ids.gather(1, columns),
+            ],
+            dim=1,
+        )
+        attention_mask = torch.cat(
+            [
+                attention_mask.new_ones(batch_size, n_prefix),
+                attention_mask.gather(1, columns),
+            ],
+            dim=1,
+        )
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        if seq_len - n_prefix > 1:
+            outputs = self.language_model.model(
+                inputs_embeds=rest_embeds[:, :-1],
+                attention_mask=attention_mask[:, :-1],
+                position_ids=position_ids[:, n_prefix:-1],
+                past_key_values=cache,
+                use_cache=True,
+            )
+            cache = outputs.past_key_values
+
+        # `generate` embeds the last token, a text token of the chat template
+        return dict(
+            input_ids=input_ids, attention_mask=attention_mask, past_key_values=cache
+        )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(entries=len(self._entries), bytes=self._bytes)
+        return stats
+
+
+def _slice(past_key_values: LegacyCache, n_tokens: int) -> LegacyCache:
+    return tuple((k[:, :, :n_tokens], v[:, :, :n_tokens]) for k, v in past_key_values)
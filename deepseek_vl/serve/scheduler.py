@@ -0,0 +1,146 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple
+
+_STOP = object()
+
+
+class MicroBatcher(object):
+    """
+    Collects items submitted by concurrent callers into batches and runs them on a
+    single worker thread.
+
+    A batch is dispatched as soon as `max_batch_size` items are waiting, or when
+    `max_wait_ms` has elapsed since the first item of the batch arrived, whichever
+    comes first.
+
+    `process_batch` receives the list of items and must return one result per item,
+    in the same order. Returning an exception instance for an item fails only that
+    item's future; raising fails the whole batch.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        name: str = "micro-batcher",
+    ):
+        assert max_batch_size > 0, "max_batch_size should be positive."
+
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+        # fail whatever was submitted after the stop request
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not _STOP and entry[1].set_running_or_notify_cancel():
+                entry[1].set_exception(RuntimeError(f"{self.name} is stopped."))
+
+    def submit(self, item: Any) -> Future:
+        """
+
+        Args:
+            item (Any): one input of `process_batch`.
+
+        Returns:
+            future (concurrent.futures.Future): resolved with the item's result.
+        """
+
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self) -> Tuple[List[Tuple[Any, Future]], bool]:
+        entry = self._queue.get()
+        if entry is _STOP:
+            return [], True
+
+        batch = [entry]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+
+        return batch, False
+
+    def _run_batch(self, batch: List[Tuple[Any, Future]]):
+        # drop the requests whose callers have already given up
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if len(batch) == 0:
+            return
+
+        items = [item for item, _ in batch]
+        try:
+            results = self.process_batch(items)
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if len(batch) > 0:
+                self._run_batch(batch)
@@ -0,0 +1,567 @@
+# Copyright (c) 2023-2024 DeepSeek.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import torch
+from transformers import (
+    DynamicCache,
+    LlamaForCausalLM,
+    PreTrainedTokenizer,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
+
+
+class SpeculativeStats(object):
+    """Counters of the speculative decoding rounds, shared by the concurrent generations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict(
+            rounds=0, proposed_tokens=0, accepted_tokens=0, generated_tokens=0
+        )
+
+    def update(self, proposed: int, accepted: int, generated: int):
+        with self._lock:
+            self._counters["rounds"] += 1
+            self._counters["proposed_tokens"] += proposed
+            self._counters["accepted_tokens"] += accepted
+            self._counters["generated_tokens"] += generated
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            stats = dict(self._counters)
+        # every round is one forward of the target model
+        stats["accept_rate"] = stats["accepted_tokens"] / max(
+            stats["proposed_tokens"], 1
+        )
+        stats["tokens_per_forward"] = stats["generated_tokens"] / max(
+            stats["rounds"], 1
+        )
+        return stats
+
+
+class Proposer(object):
+    """
+    Proposes the next tokens of a batch of sequences, for the target model to verify.
+    """
+
+    def propose(
+        self,
+        output_ids: torch.LongTensor,
+        num_tokens: int,
+        finished: Optional[torch.BoolTensor] = None,
+    ) -> torch.LongTensor:
+        """
+
+        Args:
+            output_ids (torch.LongTensor): [b, n], the tokens generated so far.
+            num_tokens (int): the most tokens to propose.
+            finished (torch.BoolTensor, optional): [b], the rows that have ended, whose
+                proposals are not checked.
+
+        Returns:
+            draft_ids (torch.LongTensor): [b, k], k <= num_tokens, the proposed tokens.
+        """
+        raise NotImplementedError
+
+    def accept(self, n_tokens: int):
+        """The generated tokens are now `n_tokens` long, the rest of the proposal is dropped."""
+
+
+class DraftModelProposer(Proposer):
+    """
+    Proposes tokens with a smaller language model sharing the tokenizer of the target,
+    e.g. the 1.3B checkpoint for the 7B one, decoding greedily from its own prompt
+    embeddings. Its KV cache is cropped to the accepted tokens after every round.
+    """
+
+    def __init__(
+        self,
+        draft_model: LlamaForCausalLM,
+        inputs_embeds: torch.Tensor,
+        attention_mask: torch.LongTensor,
+    ):
+        """
+        Args:
+            draft_model (LlamaForCausalLM): the language model of the draft checkpoint.
+            inputs_embeds (torch.Tensor): [b, T, D], the prompts embedded by the draft model.
+            attention_mask (torch.LongTensor): [b, T], left padding.
+        """
+
+        self.draft_model = draft_model
+        self.inputs_embeds = inputs_embeds
+        self.attention_mask = attention_mask
+
+        self._past_key_values = DynamicCache()
+        # the generated tokens in the draft KV cache, after the prompt
+        self._n_cached = 0
+        self._prompt_length = inputs_embeds.shape[1]
+
+    def _forward(self, attention_mask: torch.LongTensor, **inputs) -> torch.LongTensor:
+        n_new = next(iter(inputs.values())).shape[1]
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, -n_new:]
+        outputs = self.draft_model(
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+            num_logits_to_keep=1,
+            **inputs,
+        )
+        return outputs.logits[:, -1].argmax(dim=-1)
+
+    def propose(
+        self,
+        output_ids: torch.LongTensor,
+        num_tokens: int,
+        finished: Optional[torch.BoolTensor] = None,
+    ) -> torch.LongTensor:
+        batch_size, n_generated = output_ids.shape
+        if self._past_key_values.get_seq_length() == 0:
+            self._forward(self.attention_mask, inputs_embeds=self.inputs_embeds)
+
+        attention_mask = torch.cat(
+            [
+                self.attention_mask,
+                self.attention_mask.new_ones(batch_size, n_generated),
+            ],
+            dim=1,
+        )
+        # feed the generated tokens the draft has not seen yet, then its own guesses
+        next_ids = self._forward(
+            attention_mask, input_ids=output_ids[:, self._n_cached :]
+        )
+        self._n_cached = n_generated
+        draft_ids = [next_ids]
+        for _ in range(num_tokens - 1):
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones(batch_size, 1)], dim=1
+            )
+            next_ids = self._forward(attention_mask, input_ids=next_ids[:, None])
+            self._n_cached += 1
+            draft_ids.append(next_ids)
+        return torch.stack(draft_ids, dim=1)
+
+    def accept(self, n_tokens: int):
+        # the last token comes from the target model, the draft has not seen it
+        self._n_cached = min(self._n_cached, n_tokens - 1)
+        self._past_key_values.crop(self._prompt_length + self._n_cached)
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "count")
+
+    def __init__(self):
+        self.children: Dict[int, "_TrieNode"] = {}
+        self.count = 0
+
+
+class PhraseTrie(object):
+    """
+    Counts the n-grams of the phrases of a configured list, kept forever, and of the most
+    recent outputs, forgotten oldest first. Every suffix of a sequence is inserted up to
+    `max_depth` tokens deep, so that any n-gram leads to the tokens that followed it.
+    """
+
+    def __init__(self, max_depth: int = 16, max_outputs: int = 256):
+        """
+        Args:
+            max_depth (int): the longest n-gram plus continuation that is counted.
+            max_outputs (int): the number of recent outputs the trie remembers.
+        """
+
+        self.max_depth = max_depth
+        self.max_outputs = max_outputs
+
+        self._root = _TrieNode()
+        self._outputs = deque()
+        self._lock = threading.Lock()
+        self._counters = dict(phrases=0, lookups=0, hits=0)
+
+    def _update(self, token_ids: Sequence[int], delta: int):
+        for start in range(len(token_ids)):
+            node = self._root
+            for token_id in token_ids[start : start + self.max_depth]:
+                child = node.children.get(token_id)
+                if child is None:
+                    child = node.children[token_id] = _TrieNode()
+                child.count += delta
+                if child.count == 0:
+                    # the n-grams below it were only counted through it
+                    del node.children[token_id]
+                    break
+                node = child
+
+    def add(self, token_ids: Sequence[int], pinned: bool = False):
+        """
+        Args:
+            token_ids (Sequence[int]): an output, or a phrase.
+            pinned (bool): whether the sequence is a phrase, kept forever.
+        """
+
+        token_ids = list(token_ids)
+        with self._lock:
+            self._update(token_ids, 1)
+            if pinned:
+                self._counters["phrases"] += 1
+                return
+
+            self._outputs.append(token_ids)
+            while len(self._outputs) > self.max_outputs:
+                self._update(self._outputs.popleft(), -1)
+
+    def add_phrases(self, tokenizer: PreTrainedTokenizer, phrases: Iterable[str]):
+        """Add the phrases as they are tokenized at the start of the text, and after a space."""
+        for phrase in phrases:
+            for text in (phrase, " " + phrase):
+                self.add(tokenizer.encode(text, add_special_tokens=False), pinned=True)
+
+    def continuation(self, ngram: Sequence[int], num_tokens: int) -> List[int]:
+        """
+        Args:
+            ngram (Sequence[int]): the last tokens of a sequence.
+            num_tokens (int): the most tokens to return.
+
+        Returns:
+            token_ids (List[int]): the tokens that most often followed `ngram`, one at a time.
+        """
+
+        with self._lock:
+            self._counters["lookups"] += 1
+            node = self._root
+            for token_id in ngram:
+                node = node.children.get(token_id)
+                if node is None:
+                    return []
+
+            token_ids = []
+            while len(token_ids) < num_tokens and node.children:
+                token_id, node = max(
+                    node.children.items(), key=lambda item: item[1].count
+                )
+                token_ids.append(token_id)
+            if len(token_ids) > 0:
+                self._counters["hits"] += 1
+            return token_ids
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(outputs=len(self._outputs), **self._counters)
+
+
+class PromptLookupProposer(Proposer):
+    """
+    Proposes the tokens that followed the last n-gram of a sequence, earlier in its own
+    prompt and output, or else in a `PhraseTrie`. There is no second model: the proposals
+    cost a few lookups on the host and no device memory.
+    """
+
+    def __init__(
+        self,
+        phrase_trie: Optional[PhraseTrie] = None,
+        prompt_ids: Optional[List[List[int]]] = None,
+        max_ngram_size: int = 3,
+    ):
+        """
+        Args:
+            phrase_trie (PhraseTrie, optional): the phrases and the recent outputs.
+            prompt_ids (List[List[int]], optional): the text tokens of every prompt.
+            max_ngram_size (int): the longest n-gram that is looked up, the longer ones
+                are tried first.
+        """
+
+        self.phrase_trie = phrase_trie
+        self.prompt_ids = prompt_ids
+        self.max_ngram_size = max_ngram_size
+
+    def _lookup(self, token_ids: List[int], num_tokens: int) -> List[int]:
+        for n in range(min(self.max_ngram_size, len(token_ids)), 0, -1):
+            ngram = token_ids[-n:]
+            # the latest earlier occurrence of the n-gram
+            for start in range(len(token_ids) - n - 1, -1, -1):
+                if token_ids[start : start + n] == ngram:
+                    return token_ids[start + n : start + n + num_tokens]
+            if self.phrase_trie is not None:
+                continuation = self.phrase_trie.continuation(ngram, num_tokens)
+                if len(continuation) > 0:
+                    return continuation
+        return []
+
+    def propose(
+        self,
+        output_ids: torch.LongTensor,
+        num_tokens: int,
+        finished: Optional[torch.BoolTensor] = None,
+    ) -> torch.LongTensor:
+        finished = finished.tolist() if finished is not None else None
+        proposals = []
+        for i, token_ids in enumerate(output_ids.tolist()):
+            if finished is not None and finished[i]:
+                proposals.append(None)
+                continue
+            if self.prompt_ids is not None:
+                token_ids = self.prompt_ids[i] + token_ids
+            proposals.append(self._lookup(token_ids, num_tokens))
+            if len(proposals[-1]) == 0:
+                # the rows move in lockstep, this row would reject any proposal
+                break
+
+        # past the shortest proposal, the tokens would not be accepted by every row:
+        # no proposal at all makes the round a plain decode step
+        n_draft = min(
+            (len(proposal) for proposal in proposals if proposal is not None),
+            default=0,
+        )
+        return torch.tensor(
+            [
+                proposal[:n_draft] if proposal is not None else [0] * n_draft
+                for proposal in proposals
+            ]
+            + [[0] * n_draft] * (len(output_ids) - len(proposals)),
+            dtype=torch.long,
+            device=output_ids.device,
+        ).view(len(output_ids), n_draft)
+
+
+@torch.inference_mode()
+def speculative_generate(
+    language_model: LlamaForCausalLM,
+    proposer: Proposer,
+    attention_mask: torch.LongTensor,
+    eos_token_id: int,
+    pad_token_id: int,
+    max_new_tokens: int,
+    inputs_embeds: Optional[torch.Tensor] = None,
+    input_ids: Optional[torch.LongTensor] = None,
+    past_key_values: Optional[DynamicCache] = None,
+    num_speculative_tokens: int = 4,
+    streamer: Optional[BaseStreamer] = None,
+    stopping_criteria: Optional[StoppingCriteriaList] = None,
+    stats: Optional[SpeculativeStats] = None,
+) -> torch.LongTensor:
+    """
+    Greedy decoding where `proposer` guesses up to `num_speculative_tokens` tokens and
+    the target model checks them all in one forward. The output is the same as the
+    greedy output of `generate`.
+
+    The rows of a batch move in lockstep: each round keeps the proposed tokens accepted
+    by all the unfinished rows, plus the token the target predicts after them, so the
+    KV caches are cropped to the same length for all the rows.
+
+    The prompt is given as `generate` would take it: `inputs_embeds`, or `input_ids`
+    with the `past_key_values` of all but its last token (see `PrefixKVCache.prefill`).
+
+    Args:
+        language_model (LlamaForCausalLM): the target model.
+        proposer (Proposer): the draft of every round.
+        attention_mask (torch.LongTensor): [b, T], left padding.
+        eos_token_id (int): ends a sequence.
+        pad_token_id (int): fills the sequences after their end.
+        max_new_tokens (int): the generation budget.
+        streamer (BaseStreamer, optional): receives the [b, n] new tokens of each round.
+        stopping_criteria (StoppingCriteriaList, optional): called after every round.
+        stats (SpeculativeStats, optional): receives the counters of every round.
+
+    Returns:
+        output_ids (torch.LongTensor): [b, n], the generated tokens, n <= max_new_tokens.
+    """
+
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+        inputs = dict(inputs_embeds=inputs_embeds)
+    else:
+        inputs = dict(input_ids=input_ids[:, past_key_values.get_seq_length() :])
+    batch_size = attention_mask.shape[0]
+    device = attention_mask.device
+
+    if streamer is not None:
+        streamer.put(torch.empty(0, dtype=torch.long))
+
+    def forward(attention_mask: torch.LongTensor, n_new: int, **inputs) -> torch.Tensor:
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, -n_new:]
+        outputs = language_model(
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            num_logits_to_keep=n_new,
+            **inputs,
+        )
+        return outputs.logits.argmax(dim=-1)
+
+    def append(new_ids: torch.LongTensor) -> int:
+        """Append the tokens one at a time, as `generate` would, until all the rows end."""
+        nonlocal output_ids, finished
+
+        for i in range(new_ids.shape[1]):
+            # the tokens after the end of a row are padding
+            next_ids = new_ids[:, i].masked_fill(finished, pad_token_id)
+            output_ids = torch.cat([output_ids, next_ids[:, None]], dim=1)
+            finished = finished | (next_ids == eos_token_id)
+            if stopping_criteria is not None:
+                finished = finished | stopping_criteria(output_ids, None)
+            if finished.all():
+                break
+
+        if streamer is not None:
+            streamer.put(output_ids[:, output_ids.shape[1] - i - 1 :].cpu())
+        return i + 1
+
+    # the prompt gives the first token
+    n_prompt = next(iter(inputs.values())).shape[1]
+    output_ids = attention_mask.new_zeros(batch_size, 0)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    append(forward(attention_mask, n_prompt, **inputs)[:, -1:])
+
+    while output_ids.shape[1] < max_new_tokens and not finished.all():
+        n_generated = output_ids.shape[1]
+        num_tokens = min(num_speculative_tokens, max_new_tokens - n_generated - 1)
+        draft_ids = output_ids.new_zeros(batch_size, 0)
+        if num_tokens > 0:
+            draft_ids = proposer.propose(output_ids, num_tokens, finished).to(device)
+
+        # the target model scores the last token and the proposal, in one forward
+        n_draft = draft_ids.shape[1]
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones(batch_size, n_draft + 1)], dim=1
+        )
+        target_ids = forward(
+            attention_mask,
+            n_draft + 1,
+            input_ids=torch.cat([output_ids[:, -1:], draft_ids], dim=1),
+        )
+
+        # the longest proposal prefix every unfinished row agrees with
+        matches = (draft_ids == target_ids[:, :-1]).int().cumprod(dim=1).sum(dim=1)
+        n_accepted = int(matches[~finished].min()) if n_draft > 0 else 0
+        n_new = append(target_ids[:, : n_accepted + 1])
+
+        attention_mask = attention_mask[
+            :, : attention_mask.shape[1] - n_draft + n_accepted
+        ]
+        past_key_values.crop(attention_mask.shape[1])
+        proposer.accept(output_ids.shape[1])
+        if stats is not None:
+            stats.update(n_draft, n_accepted, n_new)
+
+    if streamer is not None:
+        streamer.end()
+    return output_ids
+
+
+if __name__ == "__main__":
+    import copy
+    import time
+
+    from transformers import LlamaConfig
+
+    # a random-weight target model, and as drafts: the target itself (every proposal is
+    # accepted, the upper bound), its first layer with the same embeddings and head, and
+    # prompt lookup in the batch and in a trie of earlier outputs
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=512,
+        intermediate_size=1024,
+        num_hidden_layers=8,
+        num_attention_heads=8,
+        max_position_embeddings=1024,
+    )
+    target_model = LlamaForCausalLM(config).eval()
+    early_exit_model = copy.deepcopy(target_model)
+    early_exit_model.model.layers = early_exit_model.model.layers[:1]
+    eos_token_id, max_new_tokens = 2, 96
+
+    # a batch of 4 prompts of ~600 image and text tokens
+    batch_size, seq_len = 4, 600
+    with torch.inference_mode():
+        inputs_embeds = target_model.get_input_embeddings()(
+            torch.randint(3, 1024, (batch_size, seq_len))
+        )
+    attention_mask = torch.ones(batch_size, seq_len, dtype=torch.long)
+    attention_mask[1:, :40] = 0
+
+    with torch.inference_mode():
+        # warm-up, the first forwards are slower
+        target_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            max_new_tokens=4,
+            do_sample=False,
+            pad_token_id=eos_token_id,
+        )
+        start = time.perf_counter()
+        reference = target_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=eos_token_id,
+            pad_token_id=eos_token_id,
+        )
+        print(f"generate: {time.perf_counter() - start:.2f}s")
+
+    phrase_trie = PhraseTrie()
+    proposers = [
+        (
+            "self draft",
+            lambda: DraftModelProposer(target_model, inputs_embeds, attention_mask),
+        ),
+        (
+            "first layer draft",
+            lambda: DraftModelProposer(early_exit_model, inputs_embeds, attention_mask),
+        ),
+        ("prompt lookup", lambda: PromptLookupProposer(phrase_trie)),
+        # as if the same captions had been generated before
+        (
+            "prompt lookup, trie of the outputs",
+            lambda: PromptLookupProposer(phrase_trie),
+        ),
+    ]
+    for name, make_proposer in proposers:
+        if name == "prompt lookup, trie of the outputs":
+            for output in reference.tolist():
+                phrase_trie.add(output)
+
+        for num_speculative_tokens in [2, 4, 8]:
+            stats = SpeculativeStats()
+            start = time.perf_counter()
+            outputs = speculative_generate(
+                target_model,
+                make_proposer(),
+                attention_mask,
+                eos_token_id=eos_token_id,
+                pad_token_id=eos_token_id,
+                max_new_tokens=max_new_tokens,
+                inputs_embeds=inputs_embeds,
+                num_speculative_tokens=num_speculative_tokens,
+                stats=stats,
+            )
+            elapsed = time.perf_counter() - start
+            stats = stats.stats()
+            print(
+                f"{name}, k={num_speculative_tokens}: {elapsed:.2f}s, "
+                f"accept rate {stats['accept_rate']:.2f}, "
+                f"{stats['tokens_per_forward']:.2f} tokens per forward, "
+                f"same output: {torch.equal(outputs, reference)}"
+            )
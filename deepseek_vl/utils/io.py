@@ -18,15 +18,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import json
-from typing import Dict, List
+from typing import Dict, List, Optional, Union
 
 import PIL.Image
 import torch
 import base64
-import io
 from transformers import AutoModelForCausalLM
 
 from deepseek_vl.models import MultiModalityCausalLM, VLChatProcessor
+from deepseek_vl.models.image_processing_vlm import ImageType, to_pil_image
 
 
 def load_pretrained_model(model_path: str):
@@ -41,10 +41,37 @@ def load_pretrained_model(model_path: str):
     return tokenizer, vl_chat_processor, vl_gpt
 
 
+def load_pil_image(
+    image_data: Union[str, bytes, ImageType], max_size: Optional[int] = None
+) -> PIL.Image.Image:
+    """
+
+    Args:
+        image_data (Union[str, bytes, ImageType]): a file path, a base64 data URL, the encoded
+            bytes of an image file, a PIL image or a uint8 array / tensor.
+        max_size (Optional[int]): the size of the longer side the image will be resized to,
+            large JPEG files are decoded at a reduced scale.
+
+    Returns:
+        pil_img (PIL.Image.Image): the image in RGB.
+    """
+
+    if isinstance(image_data, str):
+        if image_data.startswith("data:image"):
+            # Image data is in base64 format
+            _, image_data = image_data.split(",", 1)
+            image_data = base64.b64decode(image_data)
+        else:
+            # Image data is a file path
+            image_data = PIL.Image.open(image_data)
+
+    return to_pil_image(image_data, max_size=max_size)
+
+
 def load_pil_images(conversations: List[Dict[str, str]]) -> List[PIL.Image.Image]:
     """
 
-    Support file path or base64 images.
+    Support file paths, base64 images, encoded image bytes, PIL images and numpy arrays.
 
     Args:
         conversations (List[Dict[str, str]]): the conversations with a list of messages. An example is :
@@ -69,16 +96,7 @@ def load_pil_images(conversations: List[Dict[str, str]]) -> List[PIL.Image.Image
             continue
 
         for image_data in message["images"]:
-            if image_data.startswith("data:image"):
-                # Image data is in base64 format
-                _, image_data = image_data.split(",", 1)
-                image_bytes = base64.b64decode(image_data)
-                pil_img = PIL.Image.open(io.BytesIO(image_bytes))
-            else:
-                # Image data is a file path
-                pil_img = PIL.Image.open(image_data)
-            pil_img = pil_img.convert("RGB")
-            pil_images.append(pil_img)
+            pil_images.append(load_pil_image(image_data))
 
     return pil_images
 
@@ -1,6 +1,9 @@
 import requests
 import base64
 import argparse
+import statistics
+import threading
+import time
 
 
 def image_to_base64(image_path):
@@ -8,16 +11,73 @@ def image_to_base64(image_path):
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
+def probe_health(base_url, image_data, num_captions, interval=0.05):
+    """Poll /health while captions run and report its latency before and during the load."""
+
+    def health_latencies(stop_event, latencies):
+        while not stop_event.is_set():
+            start = time.perf_counter()
+            requests.get(f"{base_url}/health", timeout=30).raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+            time.sleep(interval)
+
+    def caption():
+        requests.post(
+            f"{base_url}/v1/caption",
+            json={"image": image_data, "max_new_tokens": 120},
+            timeout=600,
+        ).raise_for_status()
+
+    # idle baseline
+    idle, stop_event = [], threading.Event()
+    probe = threading.Thread(target=health_latencies, args=(stop_event, idle))
+    probe.start()
+    time.sleep(2)
+    stop_event.set()
+    probe.join()
+
+    # the same probe while captions are running
+    loaded, stop_event = [], threading.Event()
+    probe = threading.Thread(target=health_latencies, args=(stop_event, loaded))
+    probe.start()
+    workers = [threading.Thread(target=caption) for _ in range(num_captions)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stop_event.set()
+    probe.join()
+
+    for name, latencies in (("idle", idle), ("captioning", loaded)):
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(
+            f"/health {name}: n={len(latencies)} "
+            f"p50={statistics.median(latencies):.1f}ms p99={p99:.1f}ms max={latencies[-1]:.1f}ms"
+        )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost", help="Host for the API server")
     parser.add_argument("--port", type=int, default=8000, help="Port number for the API server")
     parser.add_argument("--image", type=str, default="images/buildings.png", help="Path to the image file")
+    parser.add_argument(
+        "--health-probe",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Run N concurrent captions and report /health latency during them",
+    )
     args = parser.parse_args()
 
     # Convert image to base64
     image_data = image_to_base64(args.image)
 
+    if args.health_probe > 0:
+        probe_health(f"http://{args.host}:{args.port}", image_data, args.health_probe)
+        return
+
     # Make request
     response = requests.post(
         f"http://localhost:{args.port}/v1/caption",
@@ -29,6 +89,16 @@ def main():
     )
 
     print(response.json()["caption"])
+
+    # The same image as raw bytes, without base64
+    with open(args.image, "rb") as image_file:
+        response = requests.post(
+            f"http://localhost:{args.port}/v1/caption/upload",
+            files={"image": image_file},
+            data={"max_new_tokens": 120},
+        )
+
+    print(response.json()["caption"])
     
     response = requests.post(
         f"http://localhost:{args.port}/v1/translation",